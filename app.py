@@ -1,20 +1,777 @@
 import os
+import io
 import sys
-from flask import Flask, jsonify, abort, request
-from models import setup_db, Movie, Actor
+import csv
+import json
+import math
+import zlib
+import base64
+import binascii
+import operator
+import time
+from datetime import date
+from functools import wraps
+from urllib.parse import urlencode
+from flask import (Flask, Response, jsonify, abort, request, make_response,
+                   stream_with_context, current_app, send_file)
+from werkzeug.test import EnvironBuilder
+from sqlalchemy import and_, func, tuple_, Date
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
+from models import (db, setup_db, format_row, bulk_insert, get_versions, parse_date, search,
+                    update_row, delete_row, update_rows, delete_rows,
+                    StaleVersionError, atomic, castings, changes_since,
+                    ChangesCompactedError, row_count, estimate_rows,
+                    replicas, pool_stats, Movie, Actor)
 from flask_cors import CORS
 
-from auth import AuthError, requires_auth
+import auth
+import metrics
+import profiling
+from auth import AuthError, requires_auth, PAYLOAD_ENVIRON_KEY
+from cache import create_cache, SingleFlight
+from serialization import dumps, json_response
 
-ITEMS_PER_PAGE = 10
+ITEMS_PER_PAGE = int(os.environ.get('ITEMS_PER_PAGE', 10))
+MAX_ITEMS_PER_PAGE = int(os.environ.get('MAX_ITEMS_PER_PAGE', 100))
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 10000))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+BULK_MODES = ('atomic', 'partial')
+COUNT_MODES = ('exact', 'estimate', 'cached')
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+MAX_BATCH_REQUESTS = int(os.environ.get('MAX_BATCH_REQUESTS', 50))
+BATCH_METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+CHANGES_PER_PAGE = int(os.environ.get('CHANGES_PER_PAGE', 100))
+MAX_CHANGES_PER_PAGE = int(os.environ.get('MAX_CHANGES_PER_PAGE', 1000))
+# a long poll holds a whole sync worker, so it is kept short unless served
+# by green.py (which raises the default to 30)
+MAX_CHANGES_WAIT = float(os.environ.get('MAX_CHANGES_WAIT', 1))
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 0.5))
 
-def pagination(request, selection):
+# set on the sub-requests of an atomic POST /batch: what they read may 
+# still be rolled back, so it must not reach the response cache
+ATOMIC_BATCH_KEY = 'casting_agency.atomic_batch'
+
+# pre-serialized list responses, see cache.py
+response_cache = create_cache()
+# identical list requests running at the same time share one computation
+read_flights = SingleFlight()
+
+# required fields, shared by the single-item and the bulk routes
+MOVIE_FIELDS = ('title', 'release_date')
+ACTOR_FIELDS = ('name', 'age', 'gender')
+
+def has_fields(req, fields):
+    return isinstance(req, dict) and all(f in req for f in fields)
+
+# ?sort= columns of the list endpoints besides id, all indexed;
+# prefix with - for descending order
+MOVIE_SORTS = {'title': Movie.title, 'release_date': Movie.release_date}
+ACTOR_SORTS = {'age': Actor.age}
+
+# ?include= options of the list endpoints, and the extra tables they read
+INCLUDE_TABLES = {
+    'cast': ('actors', 'castings'),
+    'movies': ('movies', 'castings')
+}
+
+'''
+table_versions(*tables)
+    the change versions of the tables, read once per request
+    (kept in the request environ: the app context, and so g, outlives
+    requests here)
+'''
+def table_versions(*tables):
+    include = request.args.get('include')
+    if include in INCLUDE_TABLES:
+        tables += tuple(t for t in INCLUDE_TABLES[include] if t not in tables)
+
+    versions = request.environ.setdefault('casting_agency.table_versions', {})
+    if tables not in versions:
+        versions[tables] = get_versions(*tables)
+    return versions[tables]
+
+'''
+@conditional(*tables) decorator
+    tags a GET response with an ETag built from the change versions of the
+    tables it reads; a request whose If-None-Match matches gets a 304
+    without running the query or serializing anything
+    it goes below @requires_auth, so permissions are still checked first
+'''
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # read the versions before the data: a concurrent write can only
+            # make the body newer than its tag, never older
+            versions = table_versions(*tables)
+            etag = '-'.join(str(v) for v in versions)
+            etag += '-%08x' % zlib.crc32(request.full_path.encode('utf-8'))
+
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+'''
+@cached(*tables) decorator
+    read-through response_cache for GET handlers: 200 responses are stored
+    as bytes, keyed by route, normalized query string and the versions of
+    the tables they read, so any write to those tables invalidates them
+    on a miss, identical requests (same key and permission scope) running
+    at the same time wait for one computation and share its response, 
+    counted in read_flights.stats()
+    it goes below @requires_auth, so permissions are still checked first
+'''
+def cached(*tables):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            query = urlencode(sorted(request.args.items(multi=True)))
+            versions = ','.join(str(v) for v in table_versions(*tables))
+            key = f'{request.path}?{query}#{versions}'
+            if request.environ.get(ATOMIC_BATCH_KEY):
+                return f(payload, *args, **kwargs)
+
+            body = response_cache.get(key)
+            if body is not None:
+                return Response(body, mimetype='application/json')
+
+            def compute():
+                response = make_response(f(payload, *args, **kwargs))
+                if response.status_code == 200:
+                    response_cache.set(key, response.get_data())
+                return (response.get_data(), response.status_code,
+                        response.mimetype)
+
+            scope = ' '.join(sorted(payload.permission_set))
+            body, status, mimetype = read_flights.do(f'{key}|{scope}', compute)
+            return Response(body, status=status, mimetype=mimetype)
+
+        return wrapper
+    return cached_decorator
+
+'''
+expected_version(request)
+    the row version a write is conditional on, from its If-Match header
+    (item ETags are the row version); None when there is no precondition
+    an If-Match that is not a version (or only weak tags, which If-Match 
+    never matches) can never match, so it is a 412
+'''
+def expected_version(request):
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    try:
+        return int(next(iter(request.if_match)))
+    except (StopIteration, ValueError):
+        abort(412)
+
+'''
+item_response(key, item, version)
+    json {"success": True, key: item} tagged with the row version as ETag
+'''
+def item_response(key, item, version):
+    response = jsonify({
+        'success': True,
+        key: item
+    })
+    response.set_etag(str(version))
+    return response
+
+'''
+update_item(request, model, fields, key, item_id)
+    partial update of one row in a single UPDATE ... RETURNING statement
+    - only the fields present in the body change, at least one is needed
+    - If-Match makes the update conditional on the row version (412 if 
+        stale)
+'''
+def update_item(request, model, fields, key, item_id):
+    req = request.get_json()
+    if not isinstance(req, dict) or not any(f in req for f in fields):
+        abort(400)
+
+    version = expected_version(request)
+    try:
+        row = update_row(model, item_id, model.values(req, partial=True),
+                         version)
+    except StaleVersionError:
+        abort(412)
+    except:
+        print(sys.exc_info())
+        abort(422)
+
+    if row is None:
+        abort(404)
+
+    return item_response(key, model.format(row), row.version), 200
+
+'''
+delete_item(request, model, key, item_id)
+    deletes one row in a single DELETE ... RETURNING statement, 
+    conditional on If-Match like update_item
+'''
+def delete_item(request, model, key, item_id):
+    version = expected_version(request)
+    try:
+        deleted = delete_row(model, item_id, version)
+    except StaleVersionError:
+        abort(412)
+    except:
+        print(sys.exc_info())
+        abort(422)
+
+    if not deleted:
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        key: item_id
+    }), 200
+
+'''
+batch_delete(request, model)
+    DELETE with ?ids=1,2,3 (or repeated ids=): removes up to 
+    MAX_BATCH_SIZE rows in one transaction
+    returns json {"success": True, "deleted": [], "missing": []}
+'''
+def batch_delete(request, model):
+    ids = set()
+    try:
+        for value in request.args.getlist('ids'):
+            ids.update(int(i) for i in value.split(',') if i.strip())
+    except ValueError:
+        abort(400)
+
+    if len(ids) == 0 or len(ids) > MAX_BATCH_SIZE:
+        abort(400)
+
+    try:
+        deleted, missing = delete_rows(model, ids)
+    except SQLAlchemyError:
+        print(sys.exc_info())
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted,
+        'missing': missing
+    }), 200
+
+'''
+batch_update(request, model, fields, key)
+    PATCH with json {key: [{"id": 1, <fields>...}, ...]}: partial updates 
+    of up to MAX_BATCH_SIZE rows in one transaction, a malformed item 
+    fails the whole request with 400
+    returns json {"success": True, "updated": [], "missing": []}
+'''
+def batch_update(request, model, fields, key):
+    req = request.get_json()
+    items = req.get(key) if isinstance(req, dict) else None
+    if (not isinstance(items, list) or len(items) == 0 or
+            len(items) > MAX_BATCH_SIZE):
+        abort(400)
+
+    updates = []
+    for item in items:
+        # bool is an int subclass: {"id": true} is no id
+        if (not isinstance(item, dict) or type(item.get('id')) is not int
+                or not any(f in item for f in fields)):
+            abort(400)
+        try:
+            values = model.values(item, partial=True)
+        except ValueError:
+            abort(400)
+        values['id'] = item['id']
+        updates.append(values)
+
+    try:
+        updated, missing = update_rows(model, updates)
+    except SQLAlchemyError:
+        print(sys.exc_info())
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        'missing': missing
+    }), 200
+
+'''
+get_item(request, model, key, item_id)
+    one row tagged with its version; If-None-Match with it returns 304
+'''
+def get_item(request, model, key, item_id):
+    item = model.query.filter(model.id == item_id).one_or_none()
+    if item is None:
+        abort(404)
+
+    if str(item.version) in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(str(item.version))
+        return response
+
+    return item_response(key, item.format(), item.version), 200
+
+'''
+encode_cursor(last_id, sort, key) / decode_cursor(cursor)
+    opaque keyset cursors: urlsafe base64 of the last id seen and, when
+    sorting on another column, the sort and that column's last value
+    an invalid cursor is a bad request
+'''
+def encode_cursor(last_id, sort='id', key=None):
+    state = {'id': last_id}
+    if sort != 'id':
+        state['sort'] = sort
+        state['key'] = key.isoformat() if isinstance(key, date) else key
+
+    raw = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(raw)
+        last_id = state['id']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        abort(400)
+
+    if not isinstance(last_id, int):
+        abort(400)
+    return state
+
+'''
+keyset_branches(model, column, descending, state)
+    the rows after a cursor (from the start without one) in (column, id)
+    order, NULLs sorting last, as (filter, order) branches to read in turn
+    each branch is one range of the (column, id) index, scanned forwards or
+    backwards: the NULLs are a branch of their own rather than an OR, which
+    would stop the index from answering the sort
+'''
+def keyset_branches(model, column, descending, state=None):
+    after = operator.lt if descending else operator.gt
+    by_id = model.id.desc() if descending else model.id.asc()
+    if column is None:
+        return [(after(model.id, state['id']) if state else None, [by_id])]
+
+    by_value = [column.desc() if descending else column.asc(), by_id]
+    nulls = (column.is_(None), [by_id])
+    if state is None:
+        return [(column.isnot(None), by_value), nulls]
+
+    key = state.get('key')
+    if key is None:
+        # the previous page ended among the NULLs
+        return [(and_(column.is_(None), after(model.id, state['id'])), [by_id])]
+
+    if isinstance(column.type, Date):
+        try:
+            key = parse_date(key)
+        except ValueError:
+            abort(400)
+
+    return [(after(tuple_(column, model.id), tuple_(key, state['id'])),
+             by_value), nulls]
+
+'''
+pagination(request, query, model, formatter, sorts)
+    runs one page of the query in the database, ordered by id
+    - ?page=N uses LIMIT/OFFSET
+    - ?cursor=... continues after the last row of the previous page 
+        (keyset), which stays O(per_page) however deep the page is
+    - ?per_page=N sets the page size, capped at MAX_ITEMS_PER_PAGE
+    - ?sort=column or ?sort=-column orders by one of the indexed columns 
+        in sorts first, then by id; its first page is read like a cursor
+    returns the items, formatted by formatter (default: format()), and 
+    the cursor of the next page (or None)
+'''
+def pagination(request, query, model, formatter=None, sorts=None):
+    per_page = per_page_arg(request)
+
+    sort = request.args.get("sort", "id")
+    descending = sort.startswith('-')
+    column = None
+    if sort.lstrip('-') != 'id':
+        column = (sorts or {}).get(sort.lstrip('-'))
+        if column is None:
+            abort(400)
+
+    cursor = request.args.get("cursor")
     page = request.args.get("page", 1, type=int)
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
+    if cursor is not None or (column is not None and page == 1):
+        state = None
+        if cursor is not None:
+            state = decode_cursor(cursor)
+            if state.get('sort', 'id') != sort:
+                abort(400)
+
+        # one extra row tells whether there is a next page
+        selection = []
+        for criterion, order in keyset_branches(model, column, descending,
+                                                state):
+            branch = query if criterion is None else query.filter(criterion)
+            selection += branch.order_by(*order).limit(
+                per_page + 1 - len(selection)).all()
+            if len(selection) > per_page:
+                break
+    else:
+        if page < 1:
+            return [], None
+        order = [model.id.desc() if descending else model.id.asc()]
+        if column is not None:
+            order.insert(0, (column.desc() if descending
+                             else column.asc()).nullslast())
+        # one extra row tells whether there is a next page
+        selection = query.order_by(*order).offset(
+            (page - 1) * per_page).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(selection) > per_page:
+        selection = selection[:per_page]
+        last = selection[-1]
+        key = getattr(last, column.key) if column is not None else None
+        next_cursor = encode_cursor(last.id, sort, key)
+
+    formatter = formatter or model.format
+    return [formatter(i) for i in selection], next_cursor
+
+'''
+per_page_arg(request)
+    the ?per_page= page size, ITEMS_PER_PAGE by default, capped at 
+    MAX_ITEMS_PER_PAGE
+'''
+def per_page_arg(request):
+    per_page = request.args.get("per_page", ITEMS_PER_PAGE, type=int)
+    return min(max(per_page, 1), MAX_ITEMS_PER_PAGE)
+
+'''
+page_totals(request, model, query)
+    the ?count= totals of a list response: "total" rows of the filtered
+    query, "page_count" at the current page size and the "count_mode" used
+    - exact: COUNT(*) of the filtered query
+    - estimate: the postgres planner estimate, constant time
+    - cached: the row count the write paths keep, constant time
+    estimate falls back to cached without planner statistics (sqlite), 
+    and cached to estimate then exact when the query is filtered
+    returns {} without ?count=
+'''
+def page_totals(request, model, query):
+    mode = request.args.get('count')
+    if mode is None:
+        return {}
+    if mode not in COUNT_MODES:
+        abort(400)
+
+    filtered = query.whereclause is not None
+    total = None
+    if mode == 'estimate' or (mode == 'cached' and filtered):
+        total = estimate_rows(query, model.__tablename__)
+        mode = 'estimate'
+    if total is None and not filtered and mode != 'exact':
+        total = row_count(model.__tablename__)
+        mode = 'cached'
+    if total is None:
+        total = query.with_entities(func.count(model.id)).scalar()
+        mode = 'exact'
+
+    return {
+        'total': total,
+        'page_count': -(-total // per_page_arg(request)),
+        'count_mode': mode
+    }
+
+'''
+int_arg(request, name) / date_arg(request, name)
+    optional typed query parameters, a malformed value is a bad request
+'''
+def int_arg(request, name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+def date_arg(request, name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_date(value)
+    except ValueError:
+        abort(400)
+
+'''
+fields_arg(request, model)
+    the ?fields=id,title sparse fieldset in format() order, all fields by 
+    default; unknown fields are a bad request
+'''
+def fields_arg(request, model):
+    value = request.args.get('fields')
+    if value is None:
+        return model.FIELDS
+
+    fields = {f.strip() for f in value.split(',') if f.strip()}
+    if not fields or not fields <= set(model.FIELDS):
+        abort(400)
+    return tuple(f for f in model.FIELDS if f in fields)
+
+'''
+row_query(request, model, fields, sorts)
+    selects only the columns behind fields, plus the id and sort column 
+    pagination reads, as plain rows instead of orm objects
+    format them with format_row(model, row, fields)
+'''
+def row_query(request, model, fields, sorts=None):
+    needed = set(fields) | {'id'}
+    sort = request.args.get('sort', 'id').lstrip('-')
+    if sort in (sorts or {}):
+        needed.add(sort)
+    return db.session.query(*[getattr(model, f) for f in model.FIELDS
+                              if f in needed])
+
+'''
+filter_movies(request, query) / filter_actors(request, query)
+    apply the list filters, all answered from indexed columns
+    - movies: title, release_date_from, release_date_to (inclusive)
+    - actors: gender, age_min, age_max (inclusive)
+'''
+def filter_movies(request, query):
+    title = request.args.get('title')
+    released_from = date_arg(request, 'release_date_from')
+    released_to = date_arg(request, 'release_date_to')
+
+    if title is not None:
+        query = query.filter(Movie.title == title)
+    if released_from is not None:
+        query = query.filter(Movie.release_date >= released_from)
+    if released_to is not None:
+        query = query.filter(Movie.release_date <= released_to)
+    return query
+
+def filter_actors(request, query):
+    gender = request.args.get('gender')
+    age_min = int_arg(request, 'age_min')
+    age_max = int_arg(request, 'age_max')
+
+    if gender is not None:
+        query = query.filter(Actor.gender == gender)
+    if age_min is not None:
+        query = query.filter(Actor.age >= age_min)
+    if age_max is not None:
+        query = query.filter(Actor.age <= age_max)
+    return query
+
+'''
+export(request, model, name)
+    streams the whole table as NDJSON (default) or CSV, ?format=csv,
+    reading plain rows through a server-side cursor EXPORT_BATCH_SIZE at a 
+    time so memory stays flat however big the table is
+    ?fields= limits the columns, ?gzip=true compresses the stream on the fly
+'''
+def export(request, model, name):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true')
+    fields = fields_arg(request, model)
+
+    def lines():
+        buffer = io.BytesIO()
+        text = io.TextIOWrapper(buffer, encoding='utf-8', newline='',
+                                write_through=True)
+        writer = csv.writer(text)
+        if fmt == 'csv':
+            writer.writerow(fields)
 
-    items = [i.format() for i in selection]
-    return items[start:end]
+        query = db.session.query(*[getattr(model, f) for f in fields])
+        query = query.order_by(model.id).yield_per(EXPORT_BATCH_SIZE)
+        for count, row in enumerate(query, 1):
+            item = format_row(model, row, fields)
+            if fmt == 'csv':
+                writer.writerow([item[f] for f in fields])
+            else:
+                buffer.write(dumps(item) + b'\n')
+
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue()
+
+    def encoded():
+        if not compress:
+            yield from lines()
+            return
+
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(wbits=31)
+        for chunk in lines():
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    response = Response(stream_with_context(encoded()),
+                        mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={name}.{"csv" if fmt == "csv" else "ndjson"}'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+'''
+bulk_create(request, model, fields, key)
+    validates every record in req[key] with the single-item rules and
+    inserts the valid ones with bulk_insert
+    - mode "atomic" (default): any invalid record fails the whole request
+        with 400 and nothing is written
+    - mode "partial": valid records are written, invalid ones are reported
+    returns, for each record, {"index", "id"} or {"index", "error"}
+'''
+def bulk_create(request, model, fields, key):
+    req = request.get_json()
+    if not isinstance(req, dict):
+        abort(400)
+
+    records = req.get(key)
+    mode = req.get('mode', 'atomic')
+    if (not isinstance(records, list) or len(records) == 0 or
+            len(records) > MAX_BULK_ITEMS or mode not in BULK_MODES):
+        abort(400)
+
+    results = [None] * len(records)
+    rows = []
+    positions = []
+    for index, record in enumerate(records):
+        try:
+            if not has_fields(record, fields):
+                raise ValueError('missing fields')
+            rows.append(model.values(record))
+            positions.append(index)
+        except ValueError:
+            results[index] = {'index': index, 'error': 'Bad request'}
+
+    if mode == 'atomic' and len(rows) != len(records):
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'Bad request',
+            key: [r for r in results if r is not None]
+        }), 400
+
+    try:
+        inserted = bulk_insert(model, rows, atomic=(mode == 'atomic'))
+    except SQLAlchemyError:
+        print(sys.exc_info())
+        abort(422)
+
+    for index, outcome in zip(positions, inserted):
+        if isinstance(outcome, Exception):
+            results[index] = {'index': index, 'error': 'unprocessable'}
+        else:
+            results[index] = {'index': index, 'id': outcome}
+
+    created = sum(1 for r in results if 'id' in r)
+    return jsonify({
+        'success': True,
+        key: results,
+        'created': created,
+        'failed': len(records) - created
+    }), 200
+
+'''
+change_feed(since, limit, wait)
+    the change log entries after seq since, each with the current state of
+    its row (None once deleted), loaded with one query per table
+    when there are none yet, polls for up to wait seconds (long poll)
+'''
+def change_feed(since, limit, wait=0):
+    deadline = time.monotonic() + wait
+    while True:
+        entries = changes_since(since, limit)
+        if entries or time.monotonic() >= deadline:
+            break
+        # end the read transaction so the next poll sees new commits
+        db.session.rollback()
+        time.sleep(CHANGES_POLL_INTERVAL)
+
+    found = {}
+    for model in (Movie, Actor):
+        ids = {e.row_id for e in entries if e.table_name == model.__tablename__}
+        if ids:
+            rows = db.session.query(*[getattr(model, f) for f in model.FIELDS])
+            for row in rows.filter(model.id.in_(ids)):
+                found[model.__tablename__, row.id] = format_row(
+                    model, row, model.FIELDS)
+
+    return [{
+        'seq': e.seq,
+        'type': e.table_name[:-1],
+        'id': e.row_id,
+        'op': e.op,
+        'item': found.get((e.table_name, e.row_id))
+    } for e in entries]
+
+'''
+batch_requests(request)
+    the validated sub-requests of a POST /batch body, each
+    {"method": ..., "path": ..., "body": ...}, at most MAX_BATCH_REQUESTS
+'''
+def batch_requests(request):
+    req = request.get_json()
+    if not isinstance(req, dict) or not isinstance(req.get('requests'), list):
+        abort(400)
+
+    items = req['requests']
+    if not 0 < len(items) <= MAX_BATCH_REQUESTS:
+        abort(400)
+    for item in items:
+        if (not isinstance(item, dict)
+                or item.get('method', 'GET') not in BATCH_METHODS
+                or not isinstance(item.get('path'), str)
+                or not item['path'].startswith('/')
+                or item['path'].split('?')[0] == '/batch'):
+            abort(400)
+    return items
+
+'''
+dispatch(item, payload, environ)
+    runs one sub-request through the regular routes, error handlers and 
+    permission checks, authenticated with the already verified payload
+    returns {"status": ..., "body": ...}, the body parsed when it is json
+'''
+def dispatch(item, payload, environ=None):
+    app = current_app._get_current_object()
+    builder = EnvironBuilder(path=item['path'],
+                             method=item.get('method', 'GET'),
+                             json=item.get('body'))
+    sub_environ = builder.get_environ()
+    sub_environ[PAYLOAD_ENVIRON_KEY] = payload
+    sub_environ.update(environ or {})
+
+    with app.request_context(sub_environ):
+        try:
+            response = app.full_dispatch_request()
+        except:
+            print(sys.exc_info())
+            return {'status': 500, 'body': None}
+
+    if response.is_json:
+        body = response.get_json()
+    else:
+        body = response.get_data(as_text=True) or None
+    return {'status': response.status_code, 'body': body}
 
 def create_app(test_config=None):
 
@@ -22,85 +779,148 @@ def create_app(test_config=None):
     app.app_context().push()
     setup_db(app)
     CORS(app)
+    metrics.install(app)
+    profiling.install(app)
+
+    # the app context outlives the requests, so their sessions are ended
+    # here, returning the connections to the pools (the sub-requests of a
+    # POST /batch share the session of the batch)
+    @app.teardown_request
+    def end_session(error):
+        if PAYLOAD_ENVIRON_KEY not in request.environ:
+            db.session.remove()
 
     @app.route('/')
     def get_greeting():
         return "Casting Agency."
 
+    """
+    - Implementation of endpoint GET /metrics
+    - It returns the request, latency, phase (auth, jwks, pool, db, 
+        serialization) and SQL statement metrics of this worker, the 
+        connection pool waits and usage, the read replica routing, and the 
+        cache and coalescing stats, in the prometheus text format
+    """
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(metrics.registry.render({
+            'response_cache': response_cache.stats(),
+            'read_flights': read_flights.stats(),
+            'token_cache': auth.token_cache.stats(),
+            'jwks': {'refreshes': auth.jwks_store.refresh_count},
+            'read_replicas': replicas.stats(),
+            **{'pool_' + name: stats for name, stats in pool_stats().items()}
+        }), mimetype='text/plain; version=0.0.4')
+
     #-----------------------MOVIES-----------------------------------
 
     """
     - Implementation of endpoint GET /movies
-    - It returns status code 200 and json {"success": True, "movies": []} 
-        where movies is the list of all movies, or returns appropriate 
-        status code indicating reason for failure
+    - It returns status code 200 and json {"success": True, "movies": [],
+        "next_cursor": ..., "has_next": ...} where movies is one page of 
+        movies, or returns appropriate status code indicating reason for 
+        failure
+    - Query parameters: page or cursor, per_page, include=cast to embed 
+        each movie's actors, sort=title|release_date (- for descending), 
+        the filters title, release_date_from and release_date_to, 
+        fields=id,title,... to select only some fields, and 
+        count=exact|estimate|cached to add "total" and "page_count"
+    - Responses carry an ETag; If-None-Match with it returns 304 until 
+        the table changes
     """
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional('movies')
+    @cached('movies')
     def get_movies(payload):
-        selection = Movie.query.all()
-        current_movies = pagination(request, selection)
+        fields = fields_arg(request, Movie)
+
+        # the cast of the whole page is loaded with one extra query
+        if request.args.get('include') == 'cast':
+            query = Movie.query.options(selectinload(Movie.actors))
+            keys = fields + ('actors',)
+            formatter = lambda movie: {k: v for k, v in 
+                                       movie.format_with_cast().items() 
+                                       if k in keys}
+        else:
+            query = row_query(request, Movie, fields, MOVIE_SORTS)
+            formatter = lambda row: format_row(Movie, row, fields)
+
+        query = filter_movies(request, query)
+        current_movies, next_cursor = pagination(request, query, Movie,
+                                                 formatter, MOVIE_SORTS)
 
         if len(current_movies) == 0:
             abort(404)
         
-        return jsonify({
+        return json_response({
             'success': True,
-            'movies': current_movies
-        }), 200
+            'movies': current_movies,
+            'next_cursor': next_cursor,
+            'has_next': next_cursor is not None,
+            **page_totals(request, Movie,
+                          filter_movies(request, db.session.query(Movie.id)))
+        })
 
+    """
+    - Implementation of endpoint GET /movies/export
+    - It streams every movie as NDJSON or CSV (?format=csv), optionally 
+        gzip compressed (?gzip=true) and limited to some fields (?fields=)
+    """
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional('movies')
+    def export_movies(payload):
+        return export(request, Movie, 'movies')
+
+    """
+    - Implementation of endpoint GET /movies/<movie_id>
+    - It returns status code 200 and json {"success": True, "movie": {}} 
+        with an ETag holding the movie's version, or 404
+    """
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie(payload, movie_id):
+        return get_item(request, Movie, 'movie', movie_id)
+
+    """
+    - Implementation of endpoints DELETE and PATCH /movies/<movie_id>
+    - Each runs a single statement; PATCH accepts any subset of the fields
+    - With If-Match: <version> they return 412 if the movie has changed
+    """
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-        if movie is None:
-            abort(404)
-
-        try:
-            movie.delete()
-
-            return jsonify({
-                'success': True, 
-                'deleted_movie_id': movie_id
-            }), 200
-
-        except:
-            print(sys.exc_info())
-            abort(422)
+        return delete_item(request, Movie, 'deleted_movie_id', movie_id)
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-        if movie is None:
-            abort(404)
-                    
-        req = request.get_json()
-
-        if 'title' not in req or 'release_date' not in req:
-            abort(400)
-
-        try:
-            movie.title = req['title']
-            movie.release_date = req['release_date']
-            movie.update()
+        return update_item(request, Movie, MOVIE_FIELDS, 'updated_movie',
+                           movie_id)
 
-            return jsonify({
-                'success': True, 
-                'updated_movie': movie.format()
-            }), 200
+    """
+    - Implementation of endpoints DELETE /movies?ids=1,2,3 and 
+        PATCH /movies/batch with json {"movies": [{"id": 1, ...}]}
+    - They change many movies in one transaction and return status code 
+        200 and json {"success": True, "deleted" or "updated": [], 
+        "missing": []}
+    """
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies(payload):
+        return batch_delete(request, Movie)
 
-        except:
-            print(sys.exc_info())
-            abort(422)
+    @app.route('/movies/batch', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def update_movies(payload):
+        return batch_update(request, Movie, MOVIE_FIELDS, 'movies')
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     def create_movie(payload):
         req = request.get_json()
-        if 'title' not in req or 'release_date' not in req:
+        if not has_fields(req, MOVIE_FIELDS):
             abort(400)
 
         try:
@@ -109,90 +929,334 @@ def create_app(test_config=None):
             movie = Movie(title, release_date)
             movie.insert()
 
-            return jsonify({
-                'success': True, 
-                'movie': movie.format()
-            }), 200
+            return item_response('movie', movie.format(), movie.version), 200
 
         except:
             print(sys.exc_info())
             abort(422)
 
-    #-------------------------------ACTORS---------------------------    
+    """
+    - Implementation of endpoint POST /movies/bulk
+    - It takes json {"movies": [...], "mode": "atomic" | "partial"} and 
+        returns status code 200 and json {"success": True, "movies": [],
+        "created": n, "failed": n} with the id or error of every record
+    """
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk(payload):
+        return bulk_create(request, Movie, MOVIE_FIELDS, 'movies')
+
+    #-------------------------------CASTING--------------------------
 
     """
-    - Implementation of endpoint GET /actors
-    - It returns status code 200 and json {"success": True, "actors": []} 
-        where actors is the list of all actors, or returns appropriate 
-        status code indicating reason for failure
+    - Implementation of endpoint GET /movies/<movie_id>/actors
+    - It returns status code 200 and json {"success": True, "actors": [],
+        "next_cursor": ...} with one page of the movie's cast, or 404 if 
+        the movie does not exist
     """
-    @app.route('/actors', methods=['GET'])
-    @requires_auth('get:actors')
-    def get_actors(payload):
-        selection = Actor.query.all()
-        current_actors = pagination(request, selection)
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional('movies', 'actors', 'castings')
+    @cached('movies', 'actors', 'castings')
+    def get_movie_actors(payload, movie_id):
+        if Movie.query.filter(Movie.id == movie_id).count() == 0:
+            abort(404)
 
-        if len(current_actors) == 0:
+        fields = fields_arg(request, Actor)
+        query = row_query(request, Actor, fields).join(
+            castings, castings.c.actor_id == Actor.id).filter(
+            castings.c.movie_id == movie_id)
+        actors, next_cursor = pagination(
+            request, query, Actor, lambda row: format_row(Actor, row, fields))
+
+        return json_response({
+            'success': True,
+            'actors': actors,
+            'next_cursor': next_cursor
+        })
+
+    """
+    - Implementation of endpoint GET /actors/<actor_id>/movies
+    - It returns status code 200 and json {"success": True, "movies": [],
+        "next_cursor": ...} with one page of the actor's movies, or 404 if 
+        the actor does not exist
+    """
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional('movies', 'actors', 'castings')
+    @cached('movies', 'actors', 'castings')
+    def get_actor_movies(payload, actor_id):
+        if Actor.query.filter(Actor.id == actor_id).count() == 0:
             abort(404)
-        
-        return jsonify({
+
+        fields = fields_arg(request, Movie)
+        query = row_query(request, Movie, fields).join(
+            castings, castings.c.movie_id == Movie.id).filter(
+            castings.c.actor_id == actor_id)
+        movies, next_cursor = pagination(
+            request, query, Movie, lambda row: format_row(Movie, row, fields))
+
+        return json_response({
             'success': True,
-            'actors': current_actors
-        }), 200
+            'movies': movies,
+            'next_cursor': next_cursor
+        })
 
-    @app.route('/actors/<int:actor_id>', methods=['DELETE'])
-    @requires_auth('delete:actors')
-    def delete_actor(payload, actor_id):
+    """
+    - Implementation of endpoints POST and DELETE 
+        /movies/<movie_id>/actors/<actor_id>
+    - They assign the actor to, or unassign it from, the movie's cast and
+        return status code 200 and json {"success": True, "movie_id": ..., 
+        "actor_id": ...}, or 404 if either does not exist
+    """
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['POST'])
+    @requires_auth('patch:movies')
+    def assign_actor(payload, movie_id, actor_id):
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
 
-        if actor is None:
+        if movie is None or actor is None:
             abort(404)
 
         try:
-            actor.delete()
+            movie.add_actor(actor)
 
             return jsonify({
-                'success': True, 
-                'deleted_actor_id': actor_id
+                'success': True,
+                'movie_id': movie_id,
+                'actor_id': actor_id
             }), 200
 
         except:
             print(sys.exc_info())
             abort(422)
 
-    @app.route('/actors/<int:actor_id>', methods=['PATCH'])
-    @requires_auth('patch:actors')
-    def update_actor(payload, actor_id):
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def unassign_actor(payload, movie_id, actor_id):
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
 
-        if actor is None:
+        if movie is None or actor is None or actor not in movie.actors:
             abort(404)
-                    
-        req = request.get_json()
-
-        if 'name' not in req or 'age' not in req or 'gender' not in req:
-            abort(400)
 
         try:
-            actor.name = req['name']
-            actor.age = req['age']
-            actor.gender = req['gender']
-            actor.update()
+            movie.remove_actor(actor)
 
             return jsonify({
-                'success': True, 
-                'updated_actor': actor.format()
+                'success': True,
+                'movie_id': movie_id,
+                'actor_id': actor_id
             }), 200
 
         except:
             print(sys.exc_info())
             abort(422)
 
+    #-------------------------------SEARCH---------------------------
+
+    """
+    - Implementation of endpoint GET /search?q=...
+    - It returns status code 200 and json {"success": True, "results": []}
+        where results is one page (page, per_page) of the movies and 
+        actors whose title or name match every word of q, best match 
+        first, each tagged with its "type"; 404 when the page is empty
+    """
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:movies', 'get:actors')
+    @conditional('movies', 'actors')
+    @cached('movies', 'actors')
+    def search_catalogue(payload):
+        terms = request.args.get('q', '')
+        page = request.args.get('page', 1, type=int)
+        per_page = per_page_arg(request)
+        if not terms.strip() or page < 1:
+            abort(400)
+
+        hits = search(terms, per_page, (page - 1) * per_page)
+        if len(hits) == 0:
+            abort(404)
+
+        # hydrate the hits with one query per table
+        found = {}
+        for kind, model in (('movies', Movie), ('actors', Actor)):
+            ids = [i for k, i in hits if k == kind]
+            if ids:
+                for item in model.query.filter(model.id.in_(ids)):
+                    found[kind, item.id] = item
+
+        results = []
+        for kind, item_id in hits:
+            if (kind, item_id) in found:
+                result = found[kind, item_id].format()
+                result['type'] = kind[:-1]
+                results.append(result)
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    #-------------------------------CHANGES--------------------------
+
+    """
+    - Implementation of endpoint GET /changes?since=<seq>
+    - It returns status code 200 and json {"success": True, "changes": [],
+        "next_since": seq} with up to limit (default CHANGES_PER_PAGE) 
+        movie and actor inserts, updates and deletes after seq since, 
+        oldest first, each with the current state of its row ("item", null
+        once deleted); next_since is the since of the next call
+    - wait=N holds the request up to N seconds (at most MAX_CHANGES_WAIT)
+        until there is a change
+    - 410 and json {"success": False, "error": 410, "message": "gone", 
+        "head": seq} when the changes after since were compacted: the 
+        client has to fetch everything again, then follow the log from head
+    - since=0 starts at head once the log was compacted, so a new client 
+        calls it first, fetches everything, then follows next_since
+    """
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:movies', 'get:actors')
+    def get_changes(payload):
+        since = int_arg(request, 'since') or 0
+        limit = int_arg(request, 'limit') or CHANGES_PER_PAGE
+        limit = min(max(limit, 1), MAX_CHANGES_PER_PAGE)
+        try:
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            abort(400)
+        # nan would never reach the poll deadline
+        if since < 0 or not math.isfinite(wait):
+            abort(400)
+
+        wait = min(max(wait, 0), MAX_CHANGES_WAIT)
+        try:
+            changes = change_feed(since, limit, wait)
+        except ChangesCompactedError as e:
+            if since:
+                return jsonify({
+                    'success': False,
+                    'error': 410,
+                    'message': 'gone',
+                    'head': e.head
+                }), 410
+            since = e.head
+            changes = change_feed(since, limit, wait)
+
+        return json_response({
+            'success': True,
+            'changes': changes,
+            'next_since': changes[-1]['seq'] if changes else since
+        })
+
+    #-------------------------------ACTORS---------------------------    
+
+    """
+    - Implementation of endpoint GET /actors
+    - It returns status code 200 and json {"success": True, "actors": [],
+        "next_cursor": ..., "has_next": ...} where actors is one page of 
+        actors, or returns appropriate status code indicating reason for 
+        failure
+    - Query parameters: page or cursor, per_page, include=movies to embed 
+        each actor's movies, sort=age (- for descending), the filters 
+        gender, age_min and age_max, fields=id,name,... to select only 
+        some fields, and count=exact|estimate|cached to add "total" and 
+        "page_count"
+    - Responses carry an ETag; If-None-Match with it returns 304 until 
+        the table changes
+    """
+    @app.route('/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional('actors')
+    @cached('actors')
+    def get_actors(payload):
+        fields = fields_arg(request, Actor)
+
+        # the movies of the whole page are loaded with one extra query
+        if request.args.get('include') == 'movies':
+            query = Actor.query.options(selectinload(Actor.movies))
+            keys = fields + ('movies',)
+            formatter = lambda actor: {k: v for k, v in 
+                                       actor.format_with_movies().items() 
+                                       if k in keys}
+        else:
+            query = row_query(request, Actor, fields, ACTOR_SORTS)
+            formatter = lambda row: format_row(Actor, row, fields)
+
+        query = filter_actors(request, query)
+        current_actors, next_cursor = pagination(request, query, Actor,
+                                                 formatter, ACTOR_SORTS)
+
+        if len(current_actors) == 0:
+            abort(404)
+        
+        return json_response({
+            'success': True,
+            'actors': current_actors,
+            'next_cursor': next_cursor,
+            'has_next': next_cursor is not None,
+            **page_totals(request, Actor,
+                          filter_actors(request, db.session.query(Actor.id)))
+        })
+
+    """
+    - Implementation of endpoint GET /actors/export
+    - It streams every actor as NDJSON or CSV (?format=csv), optionally 
+        gzip compressed (?gzip=true) and limited to some fields (?fields=)
+    """
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional('actors')
+    def export_actors(payload):
+        return export(request, Actor, 'actors')
+
+    """
+    - Implementation of endpoint GET /actors/<actor_id>
+    - It returns status code 200 and json {"success": True, "actor": {}} 
+        with an ETag holding the actor's version, or 404
+    """
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor(payload, actor_id):
+        return get_item(request, Actor, 'actor', actor_id)
+
+    """
+    - Implementation of endpoints DELETE and PATCH /actors/<actor_id>
+    - Each runs a single statement; PATCH accepts any subset of the fields
+    - With If-Match: <version> they return 412 if the actor has changed
+    """
+    @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actor(payload, actor_id):
+        return delete_item(request, Actor, 'deleted_actor_id', actor_id)
+
+    @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def update_actor(payload, actor_id):
+        return update_item(request, Actor, ACTOR_FIELDS, 'updated_actor',
+                           actor_id)
+
+    """
+    - Implementation of endpoints DELETE /actors?ids=1,2,3 and 
+        PATCH /actors/batch with json {"actors": [{"id": 1, ...}]}
+    - They change many actors in one transaction and return status code 
+        200 and json {"success": True, "deleted" or "updated": [], 
+        "missing": []}
+    """
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors(payload):
+        return batch_delete(request, Actor)
+
+    @app.route('/actors/batch', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def update_actors(payload):
+        return batch_update(request, Actor, ACTOR_FIELDS, 'actors')
+
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def create_actor(payload):
         req = request.get_json()
-        if 'name' not in req or 'age' not in req or 'gender' not in req:
+        if not has_fields(req, ACTOR_FIELDS):
             abort(400)
 
         try:
@@ -202,15 +1266,108 @@ def create_app(test_config=None):
             actor = Actor(name, age, gender)
             actor.insert()
 
-            return jsonify({
-                'success': True, 
-                'actor': actor.format()
-            }), 200
+            return item_response('actor', actor.format(), actor.version), 200
 
         except:
             print(sys.exc_info())
             abort(422)
 
+    """
+    - Implementation of endpoint POST /actors/bulk
+    - It takes json {"actors": [...], "mode": "atomic" | "partial"} and 
+        returns status code 200 and json {"success": True, "actors": [],
+        "created": n, "failed": n} with the id or error of every record
+    """
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk(payload):
+        return bulk_create(request, Actor, ACTOR_FIELDS, 'actors')
+
+    #-----------------------ADMIN------------------------------------
+
+    """
+    - Implementation of endpoint GET /admin/slow-queries
+    - It returns status code 200 and json {"success": True, 
+        "threshold_ms": ..., "slow_queries": []} with the most recent SQL
+        statements of this worker slower than SLOW_QUERY_MS, latest first,
+        with their parameters, route and plan
+    """
+    @app.route('/admin/slow-queries', methods=['GET'])
+    @requires_auth('admin:queries')
+    def get_slow_queries(payload):
+        return jsonify({
+            'success': True,
+            'threshold_ms': metrics.slow_queries.threshold_ms,
+            'slow_queries': json.loads(json.dumps(
+                metrics.slow_queries.entries()[::-1], default=str))
+        }), 200
+
+    """
+    - Implementation of endpoint GET /admin/profiles
+    - It returns status code 200 and json {"success": True, "profiles": []}
+        listing the saved request profiles of this host, newest first
+    - Requests are profiled when sampled (PROFILE_SAMPLE_RATE) or sent 
+        with an X-Profile header by a token with admin:profile
+    """
+    @app.route('/admin/profiles', methods=['GET'])
+    @requires_auth('admin:profile')
+    def get_profiles(payload):
+        return jsonify({
+            'success': True,
+            'profiles': profiling.list_profiles()
+        }), 200
+
+    """
+    - Implementation of endpoint GET /admin/profiles/<name>
+    - It downloads one saved profile as a pstats file, or returns 404
+    """
+    @app.route('/admin/profiles/<name>', methods=['GET'])
+    @requires_auth('admin:profile')
+    def download_profile(payload, name):
+        path = profiling.profile_path(name)
+        if path is None:
+            abort(404)
+        return send_file(path, mimetype='application/octet-stream',
+                         as_attachment=True, attachment_filename=name)
+
+    #-----------------------BATCH------------------------------------
+
+    """
+    - Implementation of endpoint POST /batch
+    - It takes json {"requests": [{"method": ..., "path": ..., "body": ...}],
+        "atomic": false} and runs the sub-requests in order, verifying the 
+        token once; each is still checked for its own permissions
+    - It returns status code 200 and json {"success": ..., "responses": [{
+        "status": ..., "body": ...}]}, success being whether every 
+        sub-request succeeded
+    - With "atomic": true they run in one database transaction, stopping 
+        at the first failure, which rolls everything back (the sub-requests
+        that did not run get status 424)
+    """
+    @app.route('/batch', methods=['POST'])
+    @requires_auth()
+    def run_batch(payload):
+        items = batch_requests(request)
+        responses = []
+
+        if request.get_json().get('atomic', False):
+            with atomic() as transaction:
+                for item in items:
+                    responses.append(dispatch(item, payload, 
+                                              {ATOMIC_BATCH_KEY: True}))
+                    if responses[-1]['status'] >= 400:
+                        transaction.rollback()
+                        break
+            responses += [{'status': 424, 'body': None}
+                          for _ in items[len(responses):]]
+        else:
+            responses = [dispatch(item, payload) for item in items]
+
+        return jsonify({
+            'success': all(r['status'] < 400 for r in responses),
+            'responses': responses
+        }), 200
+
     # -------------Error Handling---------------------
 
     @app.errorhandler(400)
@@ -235,6 +1392,28 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
     
+    @app.errorhandler(410)
+    def gone(error):
+        """
+        Receive the raised gone error (compacted change log)
+        """
+        return jsonify({
+            "success": False,
+            "error": 410,
+            "message": "gone"
+        }), 410
+    
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        """
+        Receive the raised precondition failed error (stale If-Match)
+        """
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
     @app.errorhandler(422)
     def unprocessable(error):
         """
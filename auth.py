@@ -1,16 +1,33 @@
 import os
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk, JWTError, ExpiredSignatureError
+from jose.exceptions import JWTClaimsError, JWKError
+from jose.utils import base64url_decode
 from urllib.request import urlopen
+from http.client import HTTPException
 import time
 
+from metrics import phase
+
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'aafsnd.us.auth0.com')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ.get('API_AUDIENCE', 'fsnd_casting_agency')
 
+# the jwks url can point at a local file (file:///path/jwks.json) or any
+# http stand-in, which is how the tests and benchmarks serve their own keys
+JWKS_URL = os.environ.get('AUTH0_JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = float(os.environ.get('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -22,6 +39,218 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# what fetching or parsing the key set can raise
+FETCH_ERRORS = (OSError, ValueError, HTTPException)
+
+
+## JWKS Key Store
+'''
+JWKSKeyStore
+    keeps the Auth0 signing keys in memory, parsed once and indexed by kid
+
+    the key set is served for ttl seconds; after that it is refreshed in a
+    background thread while requests keep using the last good key set
+    (stale-while-revalidate)
+    a token with an unknown kid forces one synchronous refresh, at most
+    once every min_refresh_interval seconds, so rotated keys are picked up
+    without letting bogus kids hammer Auth0
+'''
+class JWKSKeyStore:
+    def __init__(self, url=JWKS_URL, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.refresh_count = 0
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_forced_refresh = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def fetch(self):
+        with phase('jwks'), urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def refresh(self):
+        jwks = self.fetch()
+        if not isinstance(jwks, dict) or not isinstance(jwks.get('keys', []), list):
+            raise ValueError('Malformed key set.')
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            if (not isinstance(key, dict) or 'kid' not in key or
+                    key.get('use', 'sig') != 'sig'):
+                continue
+            # a key this library cannot parse (another kty or alg, or a
+            # malformed one) is skipped instead of failing the whole set
+            try:
+                keys[key['kid']] = jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+            except (JWKError, ValueError, TypeError):
+                continue
+
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self.refresh_count += 1
+
+        return keys
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def get_key(self, kid):
+        fetched_at = self._fetched_at
+
+        if fetched_at is None:
+            self._refresh_now(fetched_at)
+        elif time.monotonic() - fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._claim_forced_refresh():
+            self._refresh_now(self._fetched_at)
+            key = self._keys.get(kid)
+
+        if key is None:
+            raise AuthError('Unable to find the appropriate key.', 401)
+
+        return key
+
+    def _refresh_now(self, fetched_at):
+        with self._refresh_lock:
+            # another request already refreshed while this one was waiting
+            if self._fetched_at != fetched_at:
+                return
+            try:
+                self.refresh()
+            except FETCH_ERRORS:
+                if not self._keys:
+                    raise AuthError('Unable to fetch the signing keys.', 503)
+
+    def _claim_forced_refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if (self._last_forced_refresh is not None and
+                    now - self._last_forced_refresh < self.min_refresh_interval):
+                return False
+            self._last_forced_refresh = now
+            return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._refresh_lock:
+                self.refresh()
+        except FETCH_ERRORS:
+            # keep serving the last good key set and retry after the
+            # minimum refresh interval instead of on every request
+            with self._lock:
+                self._fetched_at = (time.monotonic() - self.ttl +
+                                    self.min_refresh_interval)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+jwks_store = JWKSKeyStore()
+
+
+## Verified Token Cache
+'''
+VerifiedPayload
+    a decoded jwt payload with its permissions precomputed as a frozenset,
+    so check_permissions is a set lookup
+'''
+class VerifiedPayload(dict):
+    def __init__(self, payload):
+        super().__init__(payload)
+        self.permission_set = frozenset(payload.get('permissions', ()))
+
+
+'''
+TokenCache
+    bounded LRU of verified payloads, keyed by a sha256 of the bearer token
+    so raw tokens are never kept in memory
+
+    an entry expires at the token's exp claim, and is dropped as soon as the
+    key that signed it is no longer in the jwks_store (key rotation)
+    maxsize 0 disables the cache
+'''
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        digest = self._digest(token)
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at, kid = entry
+            if expires_at <= time.time() or kid not in jwks_store:
+                del self._entries[digest]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload, kid):
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return
+
+        digest = self._digest(token)
+
+        with self._lock:
+            self._entries[digest] = (payload, payload['exp'], kid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+token_cache = TokenCache()
+
+
 ## Auth Header
 
 '''
@@ -60,13 +289,12 @@ def get_token_auth_header():
 '''
 def check_permissions(permission, payload):
     if 'permissions' not in payload:
-        abort(400)
+        raise AuthError('Permissions not included in JWT.', 400)
 
-    #print(permission)
-    #print(payload['permissions'])
-    #print()
+    # verified payloads carry their permissions as a frozenset
+    permissions = getattr(payload, 'permission_set', payload['permissions'])
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError('Permission not included in the payload: User Not Authorized', 401)
     
     return True
@@ -77,31 +305,61 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json,
+        served from the in-process jwks_store
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
 
+    verified payloads are kept in token_cache until the token expires,
+    so a repeated bearer token skips the RS256 verification
+
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    try:
+        header = jwt.get_unverified_header(token)
+    except JWTError:
+        raise AuthError('Unable to parse authentication token.', 401)
+
     #verify the Auth0  token has kid
-    if 'kid' not in jwt.get_unverified_header(token):
+    if 'kid' not in header:
         raise AuthError('Not a valid Auth0 token: kid missing', 401)
+    if header.get('alg') not in ALGORITHMS:
+        raise AuthError('Not a valid Auth0 token: unsupported algorithm', 401)
 
-    # get the jwks
-    jwks = json.loads(
-        urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json').read()
-    )
+    # get the parsed signing key from the cached jwks
+    key = jwks_store.get_key(header['kid'])
 
-    # decode the payload
-    payload = jwt.decode(
-            token, 
-            jwks, 
-            algorithms=ALGORITHMS,
-            audience=API_AUDIENCE,
-            issuer=f'https://{AUTH0_DOMAIN}/'
-    )
+    # verify the signature with the cached key
+    signing_input, _, signature = token.rpartition('.')
+    try:
+        signature = base64url_decode(signature.encode('utf-8'))
+    except ValueError:
+        raise AuthError('Unable to parse authentication token.', 401)
+    if not key.verify(signing_input.encode('utf-8'), signature):
+        raise AuthError('Token signature verification failed.', 401)
+
+    # decode the payload, the signature has already been checked
+    try:
+        payload = jwt.decode(
+                token, 
+                '', 
+                algorithms=ALGORITHMS,
+                audience=API_AUDIENCE,
+                issuer=f'https://{AUTH0_DOMAIN}/',
+                options={'verify_signature': False}
+        )
+    except ExpiredSignatureError:
+        raise AuthError('Token expired.', 401)
+    except JWTClaimsError:
+        raise AuthError('Incorrect claims: check the audience and issuer.', 401)
+    except JWTError:
+        raise AuthError('Unable to parse authentication token.', 401)
 
     # validating the claims
     if "iss" in payload and payload["iss"] != f"https://{AUTH0_DOMAIN}/":
@@ -109,25 +367,39 @@ def verify_decode_jwt(token):
     if "exp" in payload and payload["exp"] <= time.time():
         raise AuthError('Token expired.', 401)
 
+    payload = VerifiedPayload(payload)
+    token_cache.put(token, payload, header['kid'])
+
     return payload
 
+# the verified payload of a POST /batch, handed to its sub-requests so the
+# token is verified once (wsgi environ keys cannot be set by the client)
+PAYLOAD_ENVIRON_KEY = 'casting_agency.auth_payload'
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), further 
+            permissions may follow and are all required; without any,
+            the token is only verified
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
-def requires_auth(permission=''):
+def requires_auth(permission='', *permissions):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with phase('auth'):
+                payload = request.environ.get(PAYLOAD_ENVIRON_KEY)
+                if payload is None:
+                    token = get_token_auth_header()
+                    payload = verify_decode_jwt(token)
+                for required in (permission,) + permissions:
+                    if required:
+                        check_permissions(required, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
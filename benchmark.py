@@ -0,0 +1,547 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+from jose.utils import base64url_encode
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Offline benchmark suite
+    starts create_app against a local database (sqlite by default, or any
+    DATABASE_URL such as a local postgres), signs tokens with a locally
+    generated RSA key served from a stand-in JWKS file, seeds the requested
+    number of movies and actors, then drives every endpoint from several
+    threads and reports requests per second and p50/p95/p99 latency as json
+
+    python benchmark.py --movies 100000 --actors 100000 --output run.json
+    python benchmark.py --compare run.json --tolerance 0.15
+
+    requests go through the in-process wsgi test client, so the numbers
+    cover routing, auth, the database and serialization, not the network
+
+    --serve sync,gevent instead runs the app under gunicorn, once with sync
+    workers (app:app) and once with gevent ones (green:app), and drives
+    both over http, side by side; --db-latency-ms adds a simulated round
+    trip to every SQL statement, which is what the gevent workers overlap
+
+    python benchmark.py --serve sync,gevent --workers 2 --concurrency 100 \
+        --db-latency-ms 5 --endpoints list_movies,get_movie
+
+    --startup N times the cold start of N fresh processes: importing app.py
+    (which builds the app) and serving its first request
+'''
+
+ENDPOINTS = {
+    'list_movies': ('GET', '/movies?page={page}'),
+    'list_movies_sorted': ('GET', '/movies?sort=-release_date&per_page=50'),
+    'list_movies_with_cast': ('GET', '/movies?include=cast&page={page}'),
+    'list_actors_filtered': ('GET', '/actors?gender=female&age_min=30&page={page}'),
+    'get_movie': ('GET', '/movies/{movie_id}'),
+    'movie_actors': ('GET', '/movies/{movie_id}/actors'),
+    'search': ('GET', '/search?q={word}'),
+    'changes': ('GET', '/changes?since={since}'),
+    'update_movie': ('PATCH', '/movies/{movie_id}'),
+}
+
+PERMISSIONS = ['get:movies', 'get:actors', 'post:movies', 'post:actors',
+               'patch:movies', 'patch:actors', 'delete:movies', 'delete:actors']
+WORDS = ('night', 'river', 'empire', 'summer', 'ghost', 'city', 'storm',
+         'garden', 'silent', 'return')
+SEED_CHUNK_SIZE = 10000
+# the paginated endpoints ask for a random page up to this one, among the
+# pages the seeded data has
+MAX_PAGE = 19
+
+SERVERS = {
+    'sync': ['app:app'],
+    'gevent': ['--worker-class', 'gevent', '--worker-connections',
+               '{worker_connections}', 'green:app']
+}
+STARTUP_SCRIPT = '''\
+import os, sys, time
+import benchmark
+benchmark.add_db_latency(float(sys.argv[1]))
+
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+app.test_client().get('/movies', headers={
+    'Authorization': 'Bearer ' + os.environ['BENCHMARK_TOKEN']})
+print(imported - start, time.perf_counter() - start)
+'''
+GUNICORN_CONFIG = '''\
+import benchmark
+
+
+def post_fork(server, worker):
+    benchmark.add_db_latency({latency!r})
+'''
+
+
+'''
+setup_environment(args)
+    points the app at the benchmark database and a fresh signing key before
+    it is imported (the JWKS url is read at import time, the database url
+    when the app is set up; served apps inherit both), returns the key and
+    the working directory
+'''
+def setup_environment(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='casting-agency-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    key = RSA.generate(2048)
+    jwks = {'keys': [{
+        'kty': 'RSA', 'kid': 'benchmark', 'use': 'sig', 'alg': 'RS256',
+        'n': _b64_int(key.n), 'e': _b64_int(key.e)
+    }]}
+    jwks_path = os.path.join(workdir, 'jwks.json')
+    with open(jwks_path, 'w') as f:
+        json.dump(jwks, f)
+
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(
+        workdir, 'benchmark.db')
+    os.environ['AUTH0_JWKS_URL'] = 'file://' + jwks_path
+    os.environ['REQUEST_LOG'] = 'false'
+    if not args.cache:
+        os.environ['RESPONSE_CACHE'] = 'none'
+    return key, workdir
+
+
+def _b64_int(value):
+    return base64url_encode(
+        value.to_bytes((value.bit_length() + 7) // 8, 'big')).decode()
+
+
+def sign_token(key, auth):
+    now = int(time.time())
+    claims = {
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'aud': auth.API_AUDIENCE,
+        'sub': 'benchmark',
+        'iat': now,
+        'exp': now + 24 * 3600,
+        'permissions': PERMISSIONS
+    }
+    return jwt.encode(claims, key.export_key().decode(), algorithm='RS256',
+                      headers={'kid': 'benchmark'})
+
+
+'''
+seed(models, movies, actors, castings, rng)
+    fills empty movies/actors tables with generated rows in chunks of
+    plain executemany inserts, casts castings actors per movie, then
+    rebuilds the search index once
+'''
+def seed(models, movies, actors, castings, rng):
+    db = models.db
+    if db.session.query(models.Movie.id).first() is not None:
+        return False
+
+    first_day = date(1950, 1, 1)
+
+    def title():
+        return ' '.join(rng.choice(WORDS).title() for _ in range(3))
+
+    for start in range(0, movies, SEED_CHUNK_SIZE):
+        db.session.execute(models.Movie.__table__.insert(), [
+            {'title': title(),
+             'release_date': first_day + timedelta(days=rng.randrange(27000))}
+            for _ in range(start, min(start + SEED_CHUNK_SIZE, movies))])
+        db.session.commit()
+
+    for start in range(0, actors, SEED_CHUNK_SIZE):
+        db.session.execute(models.Actor.__table__.insert(), [
+            {'name': title(), 'age': rng.randrange(10, 90),
+             'gender': rng.choice(('female', 'male'))}
+            for _ in range(start, min(start + SEED_CHUNK_SIZE, actors))])
+        db.session.commit()
+
+    if castings and actors:
+        for start in range(1, movies + 1, SEED_CHUNK_SIZE):
+            rows = {(movie_id, rng.randrange(1, actors + 1))
+                    for movie_id in range(start, min(start + SEED_CHUNK_SIZE,
+                                                     movies + 1))
+                    for _ in range(castings)}
+            db.session.execute(models.castings.insert(), [
+                {'movie_id': m, 'actor_id': a} for m, a in rows])
+            db.session.commit()
+
+    models.rebuild_search_index()
+    return True
+
+
+'''
+add_db_latency(seconds)
+    sleeps before every SQL statement, standing in for the network round
+    trip to a remote database; time.sleep is looked up on every call, so
+    under the gevent workers it is gevent's
+'''
+def add_db_latency(seconds):
+    if seconds > 0:
+        event.listen(Engine, 'before_cursor_execute',
+                     lambda *args: time.sleep(seconds))
+
+
+'''
+GunicornServer(mode, args, workdir)
+    the app served by gunicorn on a free local port, with the workers of
+    mode (see SERVERS), while inside the with block; its test_client()
+    sends requests over http with the open() of the flask test client, so
+    run_endpoint drives it the same way
+'''
+class GunicornServer:
+    def __init__(self, mode, args, workdir):
+        self.mode = mode
+        self.args = args
+        self.workdir = workdir
+        self.address = None
+        self.process = None
+
+    def __enter__(self):
+        config = os.path.join(self.workdir, 'gunicorn_config.py')
+        with open(config, 'w') as f:
+            f.write(GUNICORN_CONFIG.format(
+                latency=self.args.db_latency_ms / 1000))
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.address = s.getsockname()
+        command = [sys.executable, '-c',
+                   'from gunicorn.app.wsgiapp import run; run()',
+                   '--workers', str(self.args.workers),
+                   '--bind', '%s:%d' % self.address,
+                   '--config', config, '--log-level', 'warning'] + [
+            arg.format(worker_connections=self.args.worker_connections)
+            for arg in SERVERS[self.mode]]
+        self.process = subprocess.Popen(
+            command, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if self.test_client().open('/').status_code == 200:
+                    return self
+            except OSError:
+                pass
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.__exit__(None, None, None)
+                raise RuntimeError(f'gunicorn ({self.mode}) did not start')
+            time.sleep(0.2)
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait(30)
+
+    def test_client(self):
+        return HTTPClient(self.address)
+
+
+_json_dumps = json.dumps
+
+
+class HTTPClient:
+    def __init__(self, address):
+        self.address = address
+
+    def open(self, path, method='GET', headers=None, json=None):
+        headers = dict(headers or {})
+        body = None
+        if json is not None:
+            body = _json_dumps(json)
+            headers['Content-Type'] = 'application/json'
+
+        connection = http.client.HTTPConnection(*self.address, timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            return SimpleNamespace(status_code=response.status)
+        finally:
+            connection.close()
+
+
+'''
+measure_startup(runs, token, db_latency)
+    p50 and max, over runs fresh interpreters, of the time to import app.py
+    and of the time to the end of its first GET /movies
+'''
+def measure_startup(runs, token, db_latency):
+    imports, first_requests = [], []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, str(db_latency)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, BENCHMARK_TOKEN=token),
+            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        imported, first_request = map(float, output.split())
+        imports.append(imported)
+        first_requests.append(first_request)
+
+    imports.sort()
+    first_requests.sort()
+    return {
+        'runs': runs,
+        'import_p50_ms': round(percentile(imports, 50) * 1000, 3),
+        'import_max_ms': round(imports[-1] * 1000, 3),
+        'first_request_p50_ms': round(percentile(first_requests, 50) * 1000, 3),
+        'first_request_max_ms': round(first_requests[-1] * 1000, 3)
+    }
+
+
+'''
+percentile(latencies, p)
+    nearest-rank percentile of sorted latencies
+'''
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    rank = max(int(round(p / 100 * len(latencies))) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+'''
+page_count(app, name, headers)
+    the pages of a paginated endpoint on the seeded data, as its 
+    ?count=exact reports them (0 when it has no rows), None for the others
+'''
+def page_count(app, name, headers):
+    method, template = ENDPOINTS[name]
+    if '{page}' not in template:
+        return None
+    response = app.test_client().get(template.format(page=1) + '&count=exact',
+                                     headers=headers)
+    if response.status_code != 200:
+        return 0
+    return response.get_json()['page_count']
+
+
+'''
+run_endpoint(app, name, headers, args, movies, rng_seed, pages)
+    sends args.requests requests to one endpoint from args.concurrency
+    threads, each with its own test client, after args.warmup untimed ones;
+    paginated endpoints only get pages that exist (of pages), and any 4xx 
+    or 5xx response counts as an error, except the 404 of an empty one
+'''
+def run_endpoint(app, name, headers, args, movies, rng_seed, pages=None):
+    method, template = ENDPOINTS[name]
+    expected = (200, 404) if pages == 0 else (200,)
+    last_page = min(pages or 1, MAX_PAGE)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    # the clock starts once every thread is warmed up
+    ready = threading.Barrier(args.concurrency + 1)
+    per_thread = max(args.requests // args.concurrency, 1)
+
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(rng_seed + index)
+
+        def send():
+            path = template.format(
+                page=rng.randrange(1, last_page + 1),
+                movie_id=rng.randrange(1, max(movies, 1) + 1),
+                word=rng.choice(WORDS),
+                since=rng.randrange(0, 100))
+            body = {'title': 'Benchmark %d' % rng.randrange(10 ** 6)}
+            return client.open(path, method=method, headers=headers,
+                               json=body if method == 'PATCH' else None)
+
+        for _ in range(args.warmup):
+            send()
+        ready.wait()
+
+        timings = []
+        failed = 0
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            response = send()
+            timings.append(time.perf_counter() - start)
+            if response.status_code not in expected:
+                failed += 1
+
+        with lock:
+            latencies.extend(timings)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3)
+    }
+
+
+'''
+compare(results, baseline, tolerance)
+    the regressions of results against a saved baseline: an endpoint
+    regresses when its rps drops, or its p95 or p99 grows, by more than
+    tolerance (a fraction)
+'''
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results['endpoints'].items():
+        base = baseline.get('endpoints', {}).get(name)
+        if base is None:
+            continue
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: rps {current['rps']} < {base['rps']}")
+        for metric in ('p95_ms', 'p99_ms'):
+            if current[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f'{name}: {metric} {current[metric]} > {base[metric]}')
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Offline benchmark of the casting agency api')
+    parser.add_argument('--database', help='DATABASE_URL to benchmark '
+                        '(default: a sqlite file in the work directory)')
+    parser.add_argument('--workdir', help='directory for the sqlite '
+                        'database and the jwks (default: a new temp dir)')
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--castings', type=int, default=3,
+                        help='actors cast per movie')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='timed requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='untimed requests per thread and endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        help='comma separated subset of: ' + ', '.join(ENDPOINTS))
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the response cache on (off by default so '
+                        'every request reaches the database)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the json report here')
+    parser.add_argument('--compare', help='baseline json report to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--serve', help='comma separated gunicorn worker '
+                        'types to serve the app with over http, side by side, '
+                        'instead of the test client: ' + ', '.join(SERVERS))
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers per server')
+    parser.add_argument('--worker-connections', type=int, default=1000,
+                        help='concurrent requests per gevent worker')
+    parser.add_argument('--db-latency-ms', type=float, default=0,
+                        help='simulated network round trip per SQL statement')
+    parser.add_argument('--startup', type=int, default=0,
+                        help='cold starts to time in fresh processes')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [n.strip() for n in args.endpoints.split(',') if n.strip()]
+    unknown = [n for n in names if n not in ENDPOINTS]
+    if unknown:
+        sys.exit(f'Unknown endpoints: {", ".join(unknown)}')
+    servers = [s.strip() for s in (args.serve or '').split(',') if s.strip()]
+    unknown = [s for s in servers if s not in SERVERS]
+    if unknown:
+        sys.exit(f'Unknown servers: {", ".join(unknown)}')
+
+    key, workdir = setup_environment(args)
+    import auth
+    import models
+    from app import app
+
+    models.create_schema()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    seeded = seed(models, args.movies, args.actors, args.castings, rng)
+    seed_seconds = time.perf_counter() - started
+    movies = models.db.session.query(models.Movie.id).count()
+
+    token = sign_token(key, auth)
+    headers = {'Authorization': 'Bearer ' + token}
+    pages = {name: page_count(app, name, headers) for name in names}
+    results = {
+        'meta': {
+            'database': models.db.engine.dialect.name,
+            'movies': movies,
+            'actors': models.db.session.query(models.Actor.id).count(),
+            'seeded': seeded,
+            'seed_seconds': round(seed_seconds, 3),
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'response_cache': args.cache,
+            'servers': servers,
+            'workers': args.workers if servers else None,
+            'db_latency_ms': args.db_latency_ms,
+            'python': platform.python_version()
+        },
+        'endpoints': {}
+    }
+    models.db.session.remove()
+
+    if args.startup:
+        results['startup'] = measure_startup(
+            args.startup, token, args.db_latency_ms / 1000)
+        print('startup', json.dumps(results['startup']), file=sys.stderr)
+
+    if not servers:
+        add_db_latency(args.db_latency_ms / 1000)
+        for index, name in enumerate(names):
+            results['endpoints'][name] = run_endpoint(
+                app, name, headers, args, movies, args.seed * 1000 + index * 100,
+                pages[name])
+            print(name, json.dumps(results['endpoints'][name]), file=sys.stderr)
+
+    # endpoints are reported as server:endpoint, e.g. gevent:list_movies
+    for server in servers:
+        with GunicornServer(server, args, workdir) as gunicorn:
+            for index, name in enumerate(names):
+                label = f'{server}:{name}'
+                results['endpoints'][label] = run_endpoint(
+                    gunicorn, name, headers, args, movies,
+                    args.seed * 1000 + index * 100, pages[name])
+                print(label, json.dumps(results['endpoints'][label]),
+                      file=sys.stderr)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    print(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+CACHE_BACKEND = os.environ.get('RESPONSE_CACHE', 'memory')
+CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 300))
+CACHE_DIR = os.environ.get(
+    'RESPONSE_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'casting-agency-cache'))
+
+'''
+Response cache backends
+    every backend stores pre-serialized response bytes by key and has
+    get(key), set(key, value), clear() and stats()
+
+    the keys built by app.cached include the change versions of the tables
+    a response reads, so a write (which bumps the version) invalidates
+    exactly the entries of that table, in every worker; stale entries are
+    never served again and age out through LRU eviction and the ttl
+'''
+
+
+'''
+MemoryCache
+    in-process LRU bounded to maxsize entries, each living ttl seconds
+'''
+class MemoryCache:
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'backend': 'memory',
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+'''
+FileCache
+    shared by every worker on the host: one file per entry in a local
+    directory, written atomically with os.replace
+    the file mtime is the write, which the ttl counts from as in
+    MemoryCache, and its atime the last use, which gives the LRU order; the
+    directory is trimmed to maxsize every EVICT_EVERY writes
+'''
+class FileCache:
+    EVICT_EVERY = 64
+
+    def __init__(self, directory=CACHE_DIR, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            written = os.stat(path).st_mtime_ns
+            if written / 1e9 + self.ttl <= time.time():
+                os.remove(path)
+                self.misses += 1
+                return None
+
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path, ns=(time.time_ns(), written))
+        except OSError:
+            # missing, or removed by another worker in the meantime
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.tmp'):
+                continue
+            try:
+                entries.append((entry.stat().st_atime, entry.path))
+            except OSError:
+                continue
+
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.maxsize, 0)]:
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'backend': 'file',
+            'size': sum(1 for e in os.scandir(self.directory)
+                        if not e.name.startswith('.tmp')),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+'''
+NullCache
+    disables response caching
+'''
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'none'}
+
+
+'''
+SingleFlight
+    coalesces identical concurrent computations in this process: the first
+    caller of do(key, fn) runs fn, callers arriving with the same key while
+    it runs wait for it and get the same result (or the same exception)
+    the result is shared between threads, so it should be immutable
+'''
+class SingleFlight:
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+'''
+create_cache(backend)
+    builds the configured backend: "memory" (default), "file" or "none"
+'''
+def create_cache(backend=CACHE_BACKEND):
+    if backend == 'memory':
+        return MemoryCache()
+    if backend == 'file':
+        return FileCache()
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f'Unknown response cache backend: {backend}')
@@ -0,0 +1,59 @@
+'''
+Cooperative serving mode
+    serves the same app as app.py from gevent greenlets, so a worker keeps
+    handling requests while others wait on Auth0 or on the database:
+
+    gunicorn -k gevent --worker-connections 1000 green:app
+    python green.py
+
+    sockets are patched, which makes the JWKS fetch cooperative, and
+    psycopg2 runs in green mode; SQL statements still wait for one of the
+    pool's connections (DB_POOL_SIZE + DB_MAX_OVERFLOW per worker), and
+    sqlite calls still block the whole worker
+    profiles (see profiling.py) cover every greenlet running while the
+    profiled request is
+    long polls on GET /changes wait up to MAX_CHANGES_WAIT, 30 seconds
+    by default here instead of 1
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from gevent.pywsgi import WSGIServer
+from gevent.socket import wait_read, wait_write
+
+try:
+    import psycopg2
+    from psycopg2 import extensions
+except ImportError:
+    psycopg2 = None
+
+
+'''
+wait_callback(conn, timeout)
+    psycopg2 wait callback that yields to the other greenlets until the
+    connection is ready, instead of blocking in libpq
+'''
+def wait_callback(conn, timeout=None):
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state!r}')
+
+
+if psycopg2 is not None:
+    extensions.set_wait_callback(wait_callback)
+
+os.environ.setdefault('MAX_CHANGES_WAIT', '30')
+
+from app import app
+
+
+if __name__ == '__main__':
+    WSGIServer(('', int(os.environ.get('PORT', 5000))), app).serve_forever()
@@ -1,14 +1,162 @@
-from flask_script import Manager
+import sys
+import csv
+import gzip
+import json
+import time
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import (db, create_schema, rebuild_search_index, compact_changes,
+                    recount_rows, load_rows, dump_rows, LOAD_BATCH_SIZE,
+                    Movie, Actor)
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+FILE_FORMATS = ('csv', 'ndjson')
+
+
+@manager.command
+def create_db():
+    """Creates the missing tables and search indexes of a development or test
+    database (deployed databases are migrated with db upgrade)"""
+    create_schema()
+
+
+@manager.command
+def rebuild_search():
+    """Rebuilds the full-text search index from the movies and actors tables"""
+    rebuild_search_index()
+
+
+@manager.command
+def compact_change_log():
+    """Drops the change log entries older than CHANGE_RETENTION_DAYS"""
+    print(f'{compact_changes()} change log entries dropped')
+
+
+@manager.command
+def recount():
+    """Resets the row counts behind ?count=cached with COUNT(*)"""
+    recount_rows()
+
+
+'''
+open_data_file(path, mode, fmt)
+    a text stream over a data file, '-' for stdin/stdout, gunzipped or
+    gzipped when it ends in .gz, and its format: fmt, or guessed from the
+    extension (.csv, otherwise ndjson)
+'''
+def open_data_file(path, mode, fmt=None):
+    name = path[:-3] if path.endswith('.gz') else path
+    fmt = fmt or ('csv' if name.endswith('.csv') else 'ndjson')
+
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+    elif path.endswith('.gz'):
+        stream = gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    else:
+        stream = open(path, mode, encoding='utf-8', newline='')
+    return stream, fmt
+
+
+class Progress:
+    """Reports rows and rows per second on stderr, at most once a second"""
+
+    def __init__(self, action):
+        self.action = action
+        self.start = self.reported = time.monotonic()
+
+    def __call__(self, rows, done=False):
+        now = time.monotonic()
+        if done or now - self.reported >= 1:
+            self.reported = now
+            rate = rows / max(now - self.start, 1e-6)
+            print(f'{self.action} {rows} rows ({rate:.0f} rows/s)',
+                  file=sys.stderr)
+
+
+class LoadCommand(Command):
+    """Bulk loads a CSV or NDJSON file (.gz, or - for stdin) in one transaction,
+    with COPY on postgres and batched executemany elsewhere"""
+
+    option_list = (
+        Option('path'),
+        Option('--format', dest='fmt', choices=FILE_FORMATS),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=LOAD_BATCH_SIZE),
+        Option('--drop-indexes', dest='drop_indexes', action='store_true',
+               help='drop the secondary indexes during the load and '
+                    'rebuild them at the end'),
+    )
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def run(self, path, fmt, batch_size, drop_indexes):
+        stream, fmt = open_data_file(path, 'r', fmt)
+        records = (csv.DictReader(stream) if fmt == 'csv'
+                   else (json.loads(line) for line in stream if line.strip()))
+
+        progress = Progress('loaded')
+        try:
+            loaded = load_rows(self.model, records, batch_size, drop_indexes,
+                               progress)
+        except ValueError as e:
+            sys.exit(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        progress(loaded, done=True)
+
+
+class DumpCommand(Command):
+    """Streams the table to a CSV or NDJSON file (.gz, or - for stdout), in id
+    order, with the same fields as the api"""
+
+    option_list = (
+        Option('path'),
+        Option('--format', dest='fmt', choices=FILE_FORMATS),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=LOAD_BATCH_SIZE),
+    )
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def run(self, path, fmt, batch_size):
+        stream, fmt = open_data_file(path, 'w', fmt)
+        writer = csv.writer(stream)
+        if fmt == 'csv':
+            writer.writerow(self.model.FIELDS)
+
+        progress = Progress('dumped')
+        rows = 0
+        try:
+            for row in dump_rows(self.model, batch_size):
+                if fmt == 'csv':
+                    writer.writerow([row[f] for f in self.model.FIELDS])
+                else:
+                    stream.write(json.dumps(row) + '\n')
+                rows += 1
+                if rows % batch_size == 0:
+                    progress(rows)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        progress(rows, done=True)
+
+
+manager.add_command('load-movies', LoadCommand(Movie))
+manager.add_command('load-actors', LoadCommand(Actor))
+manager.add_command('dump-movies', DumpCommand(Movie))
+manager.add_command('dump-actors', DumpCommand(Actor))
+
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
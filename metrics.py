@@ -0,0 +1,424 @@
+import os
+import re
+import json
+import time
+import random
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from contextlib import contextmanager
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, NullPool
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                     5.0, 30.0)
+PHASES = ('auth', 'jwks', 'pool', 'db', 'serialization')
+REQUEST_LOG = os.environ.get('REQUEST_LOG', 'true').lower() in ('1', 'true')
+# statements slower than this are logged with their plan; negative disables
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100))
+# share of slow SELECTs re-run under EXPLAIN ANALYZE (postgres only)
+SLOW_QUERY_ANALYZE_RATE = float(os.environ.get('SLOW_QUERY_ANALYZE_RATE', 0))
+
+TIMINGS_ENVIRON_KEY = 'casting_agency.timings'
+
+request_log = logging.getLogger('casting_agency.requests')
+slow_query_log = logging.getLogger('casting_agency.slow_queries')
+
+'''
+Request instrumentation
+    every request gets a RequestTimings in its environ (see install), to
+    which requires_auth, the JWKS fetch, the connection pools, the
+    SQLAlchemy engine events and the json encoder add the time they take;
+    at the end of the request the totals go to the registry behind
+    GET /metrics and to one json log line
+'''
+
+
+'''
+RequestTimings
+    time spent per phase and number of SQL statements of one request
+'''
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+
+'''
+current_timings()
+    the RequestTimings of the current request, None outside of requests
+    (background threads, manage.py commands)
+'''
+def current_timings():
+    if not has_request_context():
+        return None
+    return request.environ.get(TIMINGS_ENVIRON_KEY)
+
+'''
+phase(name) context manager
+    adds the time spent inside it to the phase of the current request
+'''
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = current_timings()
+        if timings is not None:
+            timings.phases[name] += time.perf_counter() - start
+
+
+'''
+Histogram
+    cumulative prometheus histogram over fixed buckets
+'''
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+'''
+MetricsRegistry
+    per-route request counts, latency, phase and SQL statement histograms,
+    and per-pool connection checkout waits, rendered in the prometheus text
+    format
+'''
+class MetricsRegistry:
+    PREFIX = 'casting_agency'
+
+    def __init__(self):
+        self._requests = {}
+        self._latency = {}
+        self._phases = {}
+        self._queries = {}
+        self._pool_waits = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, duration, timings):
+        with self._lock:
+            key = (method, route, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._histogram(self._latency, (method, route),
+                            LATENCY_BUCKETS).observe(duration)
+            self._histogram(self._queries, (method, route),
+                            QUERY_COUNT_BUCKETS).observe(timings.queries)
+            for name, seconds in timings.phases.items():
+                self._histogram(self._phases, (method, route, name),
+                                LATENCY_BUCKETS).observe(seconds)
+
+    def observe_pool_wait(self, pool, seconds):
+        with self._lock:
+            self._histogram(self._pool_waits, pool,
+                            POOL_WAIT_BUCKETS).observe(seconds)
+
+    @staticmethod
+    def _histogram(histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    def clear(self):
+        with self._lock:
+            for metric in (self._requests, self._latency, self._phases,
+                           self._queries, self._pool_waits):
+                metric.clear()
+
+    '''
+    render(gauges)
+        the prometheus text exposition of every metric, plus gauges, a
+        {group: stats dict} of the caches and the like, whose numeric
+        values are exported as {PREFIX}_{group}_{name}
+    '''
+    def render(self, gauges=None):
+        p = self.PREFIX
+        lines = []
+        with self._lock:
+            lines.append(f'# HELP {p}_requests_total Requests by route and status.')
+            lines.append(f'# TYPE {p}_requests_total counter')
+            for (method, route, status), count in sorted(self._requests.items()):
+                lines.append(f'{p}_requests_total{{method="{method}",'
+                             f'route="{route}",status="{status}"}} {count}')
+
+            lines.append(f'# HELP {p}_request_duration_seconds Request latency.')
+            lines.append(f'# TYPE {p}_request_duration_seconds histogram')
+            for (method, route), histogram in sorted(self._latency.items()):
+                lines.extend(histogram.lines(f'{p}_request_duration_seconds',
+                                             f'method="{method}",route="{route}"'))
+
+            lines.append(f'# HELP {p}_request_phase_seconds Time spent per '
+                         f'request in auth (jwks included), jwks fetches, '
+                         f'connection pool checkouts, SQL statements and '
+                         f'json encoding.')
+            lines.append(f'# TYPE {p}_request_phase_seconds histogram')
+            for (method, route, name), histogram in sorted(self._phases.items()):
+                lines.extend(histogram.lines(
+                    f'{p}_request_phase_seconds',
+                    f'method="{method}",route="{route}",phase="{name}"'))
+
+            lines.append(f'# HELP {p}_request_queries SQL statements per request.')
+            lines.append(f'# TYPE {p}_request_queries histogram')
+            for (method, route), histogram in sorted(self._queries.items()):
+                lines.extend(histogram.lines(f'{p}_request_queries',
+                                             f'method="{method}",route="{route}"'))
+
+            lines.append(f'# HELP {p}_pool_checkout_wait_seconds Wait for a '
+                         f'database connection, by pool.')
+            lines.append(f'# TYPE {p}_pool_checkout_wait_seconds histogram')
+            for pool, histogram in sorted(self._pool_waits.items()):
+                lines.extend(histogram.lines(f'{p}_pool_checkout_wait_seconds',
+                                             f'pool="{pool}"'))
+
+        for group, stats in sorted((gauges or {}).items()):
+            for name, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE {p}_{group}_{name} gauge')
+                    lines.append(f'{p}_{group}_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+'''
+SlowQueryLog
+    the last maxsize statements slower than threshold_ms, most recent
+    last, each with its parameters, the route that ran it and its plan
+'''
+class SlowQueryLog:
+    EXPLAINABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.I)
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, maxsize=SLOW_QUERY_LOG_SIZE,
+                 analyze_rate=SLOW_QUERY_ANALYZE_RATE):
+        self.threshold_ms = threshold_ms
+        self.analyze_rate = analyze_rate
+        self._entries = deque(maxlen=maxsize)
+        self._lock = threading.Lock()
+
+    def check(self, conn, statement, parameters, executemany, duration):
+        duration_ms = duration * 1000
+        if self.threshold_ms < 0 or duration_ms < self.threshold_ms:
+            return
+
+        analyze = (conn.dialect.name == 'postgresql'
+                   and statement.lstrip()[:6].upper() == 'SELECT'
+                   and random.random() < self.analyze_rate)
+        entry = {
+            'at': datetime.utcnow().isoformat() + 'Z',
+            'duration_ms': round(duration_ms, 3),
+            'statement': statement,
+            'parameters': parameters,
+            'route': None,
+            'path': None,
+            'plan': None if executemany else self.explain(
+                conn, statement, parameters, analyze),
+            'analyzed': analyze and not executemany
+        }
+        if has_request_context():
+            entry['route'] = request.url_rule.rule if request.url_rule else None
+            entry['path'] = request.full_path.rstrip('?')
+
+        with self._lock:
+            self._entries.append(entry)
+        slow_query_log.warning(json.dumps(entry, default=str))
+
+    '''
+    explain(conn, statement, parameters, analyze)
+        the plan of a statement that just ran, one line per row, on a raw
+        cursor of the same connection so it sees the same transaction and
+        does not go through these events again
+        on postgres it runs in a savepoint, so a failing EXPLAIN cannot 
+        abort the transaction of the request
+    '''
+    def explain(self, conn, statement, parameters, analyze=False):
+        dialect = conn.dialect.name
+        if dialect not in ('postgresql', 'sqlite') or not self.EXPLAINABLE.match(statement):
+            return None
+
+        prefix = {'sqlite': 'EXPLAIN QUERY PLAN ',
+                  'postgresql': 'EXPLAIN ANALYZE ' if analyze else 'EXPLAIN '}[dialect]
+        cursor = conn.connection.cursor()
+        try:
+            if dialect == 'postgresql':
+                cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = [str(row[-1]) for row in cursor.fetchall()]
+            except Exception as e:
+                if dialect == 'postgresql':
+                    cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return [f'EXPLAIN failed: {e}']
+            if dialect == 'postgresql':
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        finally:
+            cursor.close()
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_queries = SlowQueryLog()
+
+
+'''
+TimedPool
+    connection pool mixin that times every checkout, i.e. the wait for an
+    idle connection or a new one, as the pool phase of the current request
+    and in the checkout histogram of the pool (named by its logging name),
+    and counts the connections checked out of it
+'''
+class TimedPool:
+    _checked_out = 0
+    _count_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            timings = current_timings()
+            if timings is not None:
+                timings.phases['pool'] += wait
+            registry.observe_pool_wait(self.logging_name or 'default', wait)
+
+        with self._count_lock:
+            self._checked_out += 1
+        return connection
+
+    def _do_return_conn(self, conn):
+        with self._count_lock:
+            self._checked_out -= 1
+        super()._do_return_conn(conn)
+
+    @property
+    def checked_out(self):
+        return self._checked_out
+
+    def stats(self):
+        return {'checked_out': self._checked_out}
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    def stats(self):
+        return {'checked_out': self._checked_out, 'size': self.size(),
+                'idle': self.checkedin(), 'overflow': max(self.overflow(), 0)}
+
+
+class TimedNullPool(TimedPool, NullPool):
+    pass
+
+
+'''
+SQLAlchemy engine events
+    count the statements of the current request and time them as its
+    db phase, and hand the slow ones to slow_queries; a stack per 
+    connection handles nested executions, and failed statements are popped
+    off it by handle_error
+'''
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('casting_agency.query_start', []).append(
+        time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['casting_agency.query_start'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.queries += 1
+        timings.phases['db'] += duration
+    slow_queries.check(conn, statement, parameters, executemany, duration)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # a failed statement gets no after_cursor_execute: pop its start here,
+    # or the stack of a pooled connection keeps growing
+    conn = context.connection
+    if conn is None or context.execution_context is None:
+        return
+    starts = conn.info.get('casting_agency.query_start')
+    if starts:
+        duration = time.perf_counter() - starts.pop()
+        timings = current_timings()
+        if timings is not None:
+            timings.phases['db'] += duration
+
+
+'''
+install(app)
+    starts the timings of every request of the app and, once its response
+    is ready, records them under the route rule (e.g. /movies/<int:movie_id>)
+    and writes one structured log line with the query count
+'''
+def install(app):
+    for logger, enabled in ((request_log, REQUEST_LOG), (slow_query_log, True)):
+        if enabled and not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_timings():
+        request.environ[TIMINGS_ENVIRON_KEY] = RequestTimings()
+
+    @app.after_request
+    def record_timings(response):
+        timings = current_timings()
+        if timings is None:
+            return response
+
+        duration = time.perf_counter() - timings.start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.observe(request.method, route, response.status_code,
+                         duration, timings)
+
+        request_log.info(json.dumps({
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'route': route,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'queries': timings.queries,
+            **{f'{name}_ms': round(seconds * 1000, 3)
+               for name, seconds in timings.phases.items()}
+        }))
+        return response
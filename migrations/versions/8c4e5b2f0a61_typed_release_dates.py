@@ -0,0 +1,89 @@
+"""typed movie release dates and indexes for filtering and sorting
+
+movies.release_date goes from a free-form String to a Date: MM/DD/YYYY and
+YYYY-MM-DD values are converted, anything else becomes NULL.
+
+Revision ID: 8c4e5b2f0a61
+Revises: 6e0a4c9b3d72
+Create Date: 2026-10-17 10:02:17.518340
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e5b2f0a61'
+down_revision = '6e0a4c9b3d72'
+branch_labels = None
+depends_on = None
+
+
+def _parse_date(value):
+    for date_format in ('%m/%d/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format).date()
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        op.execute(r"""
+            ALTER TABLE movies ALTER COLUMN release_date TYPE DATE USING
+            CASE
+                WHEN release_date ~ '^\d{1,2}/\d{1,2}/\d{4}$'
+                    THEN to_date(release_date, 'MM/DD/YYYY')
+                WHEN release_date ~ '^\d{4}-\d{2}-\d{2}$'
+                    THEN to_date(release_date, 'YYYY-MM-DD')
+            END
+        """)
+    else:
+        # no ALTER COLUMN TYPE (sqlite): convert the values in python and
+        # let batch mode rebuild the table
+        movies = sa.table('movies',
+                          sa.column('id', sa.Integer),
+                          sa.column('release_date', sa.String))
+        rows = bind.execute(
+            sa.select([movies.c.id, movies.c.release_date])).fetchall()
+
+        with op.batch_alter_table('movies') as batch_op:
+            batch_op.alter_column('release_date',
+                                  existing_type=sa.String(),
+                                  type_=sa.Date())
+
+        dated = sa.table('movies',
+                         sa.column('id', sa.Integer),
+                         sa.column('release_date', sa.Date))
+        for movie_id, release_date in rows:
+            bind.execute(dated.update()
+                         .where(dated.c.id == movie_id)
+                         .values(release_date=_parse_date(release_date)))
+
+    # (column, id): the sorts page through both, forwards or backwards
+    op.create_index('ix_movies_release_date', 'movies', ['release_date', 'id'], unique=False)
+    op.create_index('ix_movies_title', 'movies', ['title', 'id'], unique=False)
+    op.create_index('ix_actors_age', 'actors', ['age', 'id'], unique=False)
+    op.create_index('ix_actors_gender', 'actors', ['gender'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute("ALTER TABLE movies ALTER COLUMN release_date TYPE VARCHAR "
+                   "USING to_char(release_date, 'MM/DD/YYYY')")
+    else:
+        with op.batch_alter_table('movies') as batch_op:
+            batch_op.alter_column('release_date',
+                                  existing_type=sa.Date(),
+                                  type_=sa.String())
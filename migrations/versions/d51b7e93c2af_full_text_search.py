@@ -0,0 +1,40 @@
+"""full-text search index over movie titles and actor names
+
+Revision ID: d51b7e93c2af
+Revises: 8c4e5b2f0a61
+Create Date: 2026-10-17 11:40:05.927614
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd51b7e93c2af'
+down_revision = '8c4e5b2f0a61'
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCH_COLUMNS.items():
+        if dialect == 'postgresql':
+            op.execute(f"CREATE INDEX ix_{table}_{column}_tsv ON {table} "
+                       f"USING gin (to_tsvector('simple', coalesce({column}, '')))")
+        elif dialect == 'sqlite':
+            op.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts "
+                       f"USING fts5({column})")
+            op.execute(f"DELETE FROM {table}_fts")
+            op.execute(f"INSERT INTO {table}_fts (rowid, {column}) "
+                       f"SELECT id, {column} FROM {table}")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCH_COLUMNS.items():
+        if dialect == 'postgresql':
+            op.execute(f"DROP INDEX ix_{table}_{column}_tsv")
+        elif dialect == 'sqlite':
+            op.execute(f"DROP TABLE IF EXISTS {table}_fts")
@@ -1,86 +1,1080 @@
 import os
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import io
+import re
+import csv
+import time
+import weakref
+import threading
+from itertools import count
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from flask import request, has_request_context
+from sqlalchemy import (Column, String, Date, DateTime, create_engine, text,
+                        and_, bindparam, func, event, orm)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, TimeoutError
+from sqlalchemy.sql.expression import SelectBase, TextClause
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+from metrics import TimedPool, TimedQueuePool, TimedNullPool
+
+'''
+database_url() / replica_urls()
+    the urls of the database (DATABASE_URL) and of its read replicas
+    (DATABASE_REPLICA_URLS, comma separated, serving the GET requests),
+    read when the app is set up rather than on import; database_url() is
+    None when DATABASE_URL is not set
+'''
+def database_url():
+  url = os.environ.get('DATABASE_URL')
+  return _database_url(url) if url else None
+
+
+def replica_urls():
+  return [_database_url(url.strip()) for url in
+          os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+          if url.strip()]
+
+
+def _database_url(url):
+  if url.startswith("postgres://"):
+    url = url.replace("postgres://", "postgresql://", 1)
+  return url
+
+
+REPLICA_STRATEGY = os.environ.get('REPLICA_STRATEGY', 'round_robin')
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+# connection pool of each server database engine (sqlite is not pooled)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true')
+# postgres statement_timeout of every connection, 0 for none
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+
+CHANGE_RETENTION_DAYS = int(os.environ.get('CHANGE_RETENTION_DAYS', 30))
+BULK_INSERT_CHUNK_SIZE = int(os.environ.get('BULK_INSERT_CHUNK_SIZE', 1000))
+LOAD_BATCH_SIZE = int(os.environ.get('LOAD_BATCH_SIZE', 10000))
+
+# release dates are accepted as MM/DD/YYYY (the api's original format,
+# still used in responses) or ISO YYYY-MM-DD
+DATE_FORMAT = '%m/%d/%Y'
+ISO_DATE_FORMAT = '%Y-%m-%d'
+
+READ_METHODS = ('GET', 'HEAD')
+READ_STATEMENT = re.compile(r'\s*(SELECT|WITH|EXPLAIN)\b', re.I)
+
+'''
+RoutingSession
+    the session of the app: while a GET or HEAD request is handled, its
+    reads (SELECTs that do not lock rows) go to a read replica, picked once
+    per transaction; flushes, writes and everything outside of read 
+    requests stay on the primary, and so do sessions bound to a connection
+    by atomic()
+    replicas lag behind the primary, so a read right after a write may not
+    see it yet
+'''
+class RoutingSession(SignallingSession):
+  def __init__(self, db, **options):
+    super().__init__(db, **options)
+    self._replica = None
+    event.listen(self, 'after_transaction_end', self._release_replica)
+
+  def get_bind(self, mapper=None, clause=None):
+    if self._routes_to_replica(clause):
+      if self._replica is None:
+        self._replica = replicas.connect() or False
+      if self._replica:
+        return self._replica
+    return super().get_bind(mapper, clause)
+
+  def _routes_to_replica(self, clause):
+    if not replicas.engines or self._flushing or self.bind is not db.engine:
+      return False
+    if not has_request_context() or request.method not in READ_METHODS:
+      return False
+    if isinstance(clause, SelectBase):
+      return getattr(clause, '_for_update_arg', None) is None
+    if isinstance(clause, TextClause):
+      return READ_STATEMENT.match(clause.text) is not None
+    return False
+
+  @staticmethod
+  def _release_replica(session, transaction):
+    if transaction.parent is None:
+      if session._replica:
+        session._replica.close()
+      session._replica = None
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+  def get_engine(self, app=None, bind=None):
+    # an app set up without DATABASE_URL still imports, and fails here, on
+    # its first query, instead of falling back to an in-memory database
+    if bind is None and self.get_app(app).config[
+        'SQLALCHEMY_DATABASE_URI'] is None:
+      raise RuntimeError('DATABASE_URL is not set')
+    return super().get_engine(app, bind)
+
+  def create_engine(self, sa_url, engine_opts):
+    engine = super().create_engine(sa_url, engine_opts)
+    _engines.add(engine)
+    return engine
+
+
+db = RoutingSQLAlchemy()
+_engines = weakref.WeakSet()
+
+
+'''
+Fork safety
+    a child process (gunicorn --preload workers, multiprocessing) starts
+    with empty pools and no session; whatever the parent had opened is 
+    kept aside, neither used nor closed by the child, as closing it would
+    also end the parent's connections
+'''
+_inherited = []
+
+
+def _reset_after_fork():
+  if db.session.registry.has():
+    _inherited.append(db.session.registry())
+    db.session.registry.clear()
+  for engine in list(_engines):
+    _inherited.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+'''
+ReplicaSet
+    the read replica engines, taken in turn (round_robin) or by fewest 
+    checked out connections (least_connections); a replica that cannot be
+    connected to is skipped for retry_seconds, and reads fall back to the
+    primary when no replica is left
+'''
+class ReplicaSet:
+  def __init__(self, engines=(), strategy=REPLICA_STRATEGY,
+               retry_seconds=REPLICA_RETRY_SECONDS):
+    if strategy not in ('round_robin', 'least_connections'):
+      raise ValueError(f'Unknown replica strategy: {strategy}')
+    self.engines = list(engines)
+    self.strategy = strategy
+    self.retry_seconds = retry_seconds
+    self.reads = 0
+    self.fallbacks = 0
+    self._down_until = {}
+    self._turn = count()
+    self._lock = threading.Lock()
+
+  '''
+  connect()
+      a connection to the next available replica, None to read from the
+      primary
+  '''
+  def connect(self):
+    for engine in self._candidates():
+      try:
+        connection = engine.connect()
+      except TimeoutError:
+        # its pool is exhausted, the replica itself is fine
+        continue
+      except SQLAlchemyError:
+        with self._lock:
+          self._down_until[engine] = time.monotonic() + self.retry_seconds
+        continue
+      with self._lock:
+        self.reads += 1
+      return connection
+
+    with self._lock:
+      self.fallbacks += 1
+    return None
+
+  def _candidates(self):
+    now = time.monotonic()
+    with self._lock:
+      engines = [e for e in self.engines if self._down_until.get(e, 0) <= now]
+      if not engines:
+        return []
+      turn = next(self._turn) % len(engines)
+    engines = engines[turn:] + engines[:turn]
+    if self.strategy == 'least_connections':
+      # ties keep their round robin order
+      engines.sort(key=lambda e: getattr(e.pool, 'checked_out', 0))
+    return engines
+
+  def stats(self):
+    now = time.monotonic()
+    with self._lock:
+      return {
+        'replicas': len(self.engines),
+        'replicas_up': sum(self._down_until.get(e, 0) <= now
+                           for e in self.engines),
+        'reads': self.reads,
+        'fallbacks': self.fallbacks
+      }
+
+  '''
+  configure(engines)
+      replaces the replicas, closing the connections of the previous ones
+  '''
+  def configure(self, engines):
+    for engine in self.engines:
+      engine.dispose()
+    with self._lock:
+      self.engines = list(engines)
+      self._down_until.clear()
+
+
+replicas = ReplicaSet()
+
+
+'''
+engine_options(url, name)
+    the SQLAlchemy engine options of a database: a pool sized by the DB_POOL
+    settings whose checkouts are timed under name (see metrics.TimedPool), 
+    and the statement timeout on postgres
+    sqlite files keep one connection per checkout, in-memory databases the
+    single connection flask-sqlalchemy gives them
+'''
+def engine_options(url, name):
+  url = make_url(url)
+  if url.get_backend_name() == 'sqlite':
+    if url.database in (None, '', ':memory:'):
+      return {}
+    return {'poolclass': TimedNullPool, 'pool_logging_name': name}
+
+  options = {
+    'poolclass': TimedQueuePool,
+    'pool_logging_name': name,
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+    'pool_pre_ping': DB_POOL_PRE_PING
+  }
+  if url.get_backend_name() == 'postgresql' and DB_STATEMENT_TIMEOUT_MS > 0:
+    options['connect_args'] = {
+      'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'}
+  return options
+
+
+def _create_replica_engine(app, url, name):
+  url = make_url(url)
+  options = {}
+  db.apply_driver_hacks(app, url, options)
+  options.update(engine_options(url, name))
+  return db.create_engine(url, options)
+
+
+'''
+pool_stats()
+    the checked out (and, when pooled, idle and overflow) connections of 
+    the primary and of every replica, by pool name
+'''
+def pool_stats():
+  return {engine.pool.logging_name: engine.pool.stats()
+          for engine in [db.engine] + replicas.engines
+          if isinstance(engine.pool, TimedPool)}
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with the read 
+    replicas of replica_paths (database_url() and replica_urls() by 
+    default); nothing connects to the database until it is used
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, replica_paths=None):
+    database_path = database_path or database_url()
+    if replica_paths is None:
+        replica_paths = replica_urls()
+
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = (
+        engine_options(database_path, 'primary') if database_path else {})
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+    replicas.configure(_create_replica_engine(app, url, f'replica{i}')
+                       for i, url in enumerate(replica_paths))
+
+
+'''
+create_schema()
+    creates the missing tables and search indexes of a development or test
+    database (manage.py create_db); deployed databases are migrated
+'''
+def create_schema():
+  db.create_all()
+  create_search_index()
+
+
+'''
+atomic()
+    runs everything inside it in one database transaction of the current
+    thread, committed on exit, or rolled back by an exception or by calling 
+    rollback() on the transaction it yields
+    the session of the thread is swapped for one bound to that transaction,
+    so the commits of the code inside only end subtransactions, and a 
+    session rollback aborts the whole transaction
+'''
+@contextmanager
+def atomic():
+  connection = db.engine.connect()
+  transaction = connection.begin()
+  registry = db.session.registry
+  previous = registry() if registry.has() else None
+  registry.set(db.create_session({'bind': connection, 'binds': {}})())
+
+  try:
+    yield transaction
+    if transaction.is_active:
+      transaction.commit()
+  except:
+    if transaction.is_active:
+      transaction.rollback()
+    raise
+  finally:
+    registry().close()
+    connection.close()
+    if previous is not None:
+      registry.set(previous)
+    else:
+      registry.clear()
+
+
+'''
+parse_date(value) / format_date(value)
+    convert release dates between the api strings and date objects
+    parse_date raises ValueError for anything else
+'''
+def parse_date(value):
+  if isinstance(value, date):
+    return value
+  if not isinstance(value, str):
+    raise ValueError(f'Invalid date: {value!r}')
+
+  for date_format in (DATE_FORMAT, ISO_DATE_FORMAT):
+    try:
+      return datetime.strptime(value, date_format).date()
+    except ValueError:
+      pass
+  raise ValueError(f'Invalid date: {value!r}')
+
+
+def format_date(value):
+  return value.strftime(DATE_FORMAT) if value is not None else None
+
+
+'''
+format_row(model, row, fields)
+    the format() dict of a plain row, restricted to fields: rows selected
+    column by column skip the orm objects entirely, and only need the
+    attributes in fields
+'''
+ROW_FORMATTERS = {'release_date': format_date}
+
+
+def format_row(model, row, fields):
+  return {f: ROW_FORMATTERS[f](getattr(row, f)) if f in ROW_FORMATTERS
+          else getattr(row, f)
+          for f in fields}
+
+
+'''
+TableVersion Class
+Have Attributes: name (table name), version and row_count
+    a change counter per table, bumped in the same transaction as every
+    write, so all gunicorn workers agree on it (used for ETags)
+    row_count is the number of rows of movies and actors, kept up to date
+    by the same writes (NULL until first counted, see row_count())
+'''
+class TableVersion(db.Model):
+  __tablename__ = 'table_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(db.Integer, nullable=False, default=0)
+  row_count = Column(db.BigInteger)
+
+
+'''
+bump_version(table_name, row_delta)
+    increments the change counter of a table in the current transaction,
+    and moves its row count by row_delta (inserted minus deleted rows)
+'''
+def bump_version(table_name, row_delta=0):
+  table = TableVersion.__table__
+  result = db.session.execute(
+    table.update()
+      .where(table.c.name == table_name)
+      .values(version=table.c.version + 1,
+              row_count=table.c.row_count + row_delta))
+  if result.rowcount:
+    return
+
+  # first write to this table: create its counter, another worker may
+  # be doing the same, in which case its row is bumped instead
+  try:
+    with db.session.begin_nested():
+      db.session.execute(table.insert().values(name=table_name, version=1))
+  except IntegrityError:
+    bump_version(table_name, row_delta)
+
+
+'''
+get_versions(*table_names)
+    returns the current change counter of each table, 0 if never written
+'''
+def get_versions(*table_names):
+  table = TableVersion.__table__
+  rows = db.session.execute(
+    table.select().where(table.c.name.in_(table_names))).fetchall()
+  versions = {row.name: row.version for row in rows}
+  return [versions.get(name, 0) for name in table_names]
+
+
+'''
+row_count(table_name)
+    the row count kept in table_versions, read in constant time
+    a table that was never counted (created before the counts, or loaded
+    around the write paths) is counted once with COUNT(*) first
+'''
+def row_count(table_name):
+  table = TableVersion.__table__
+  count = db.session.execute(
+    table.select().with_only_columns([table.c.row_count])
+      .where(table.c.name == table_name)).scalar()
+  if count is None:
+    count = recount_rows(table_name)
+  return count
+
+
+COUNTED_TABLES = ('movies', 'actors')
+
+'''
+recount_rows(*table_names)
+    resets the kept row counts with COUNT(*) on the primary (all 
+    COUNTED_TABLES by default), returns the count of the last one
+'''
+def recount_rows(*table_names):
+  table = TableVersion.__table__
+  count = None
+  try:
+    for name in table_names or COUNTED_TABLES:
+      _lock_counter(name)
+      # on the primary's connection even during a GET: a lagging
+      # replica's count would be kept as the authoritative one
+      count = db.session.connection().execute(
+        text(f"SELECT COUNT(*) FROM {name}")).scalar()
+      db.session.execute(table.update()
+                         .where(table.c.name == name)
+                         .values(row_count=count))
+    db.session.commit()
+  except SQLAlchemyError:
+    db.session.rollback()
+    raise
+  return count
+
+
+'''
+_lock_counter(table_name)
+    locks the table_versions row of table_name (the write lock on sqlite)
+    until the end of the transaction, creating it if needed: bump_version
+    waits on it, so no write commits its delta between a COUNT(*) and the
+    count replacing it
+'''
+def _lock_counter(table_name):
+  table = TableVersion.__table__
+  if db.session.execute(table.update()
+                        .where(table.c.name == table_name)
+                        .values(version=table.c.version)).rowcount:
+    return
+
+  try:
+    with db.session.begin_nested():
+      db.session.execute(table.insert().values(name=table_name, version=0))
+  except IntegrityError:
+    _lock_counter(table_name)
+
+
+'''
+estimate_rows(query, table_name)
+    a constant-time estimate of the rows of a query on table_name from the
+    postgres planner: pg_class.reltuples when it is not filtered, the row 
+    estimate of its plan otherwise; None on other databases, or when the
+    table was never analyzed (reltuples is -1 from postgres 14, 0 before)
+'''
+def estimate_rows(query, table_name):
+  if _dialect_name() != 'postgresql':
+    return None
+
+  if query.whereclause is None:
+    estimate = db.session.execute(
+      text("SELECT reltuples FROM pg_class WHERE oid = CAST(:name AS regclass)"),
+      {'name': table_name}).scalar()
+  else:
+    compiled = query.statement.compile(dialect=db.session.get_bind().dialect)
+    plan = db.session.connection().execute(
+      'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+      plan = json.loads(plan)
+    estimate = plan[0]['Plan']['Plan Rows']
+
+  if estimate is None or estimate <= 0:
+    return None
+  return int(estimate)
+
+
+'''
+Change Class
+Have Attributes: seq, table_name, row_id, op and changed_at
+    the change log behind GET /changes: one entry per inserted, updated 
+    or deleted movie or actor, in commit order
+'''
+class Change(db.Model):
+  __tablename__ = 'changes'
+  # seqs are never reused, even once compacted
+  __table_args__ = {'sqlite_autoincrement': True}
+
+  seq = Column(db.Integer, primary_key=True)
+  table_name = Column(String, nullable=False)
+  row_id = Column(db.Integer, nullable=False)
+  op = Column(String, nullable=False)
+  changed_at = Column(DateTime, nullable=False, index=True)
+
+
+# the table_versions entry holding the last compacted seq
+COMPACTED_CHANGES = 'changes_compacted'
+
+
+'''
+log_changes(table_name, op, row_ids)
+    appends an 'insert', 'update' or 'delete' entry per row in the current
+    transaction, so it commits or rolls back with the write itself
+    the 'changes' counter is bumped first: its row lock orders the
+    writers, so seqs become visible in increasing order
+'''
+def log_changes(table_name, op, row_ids):
+  if not row_ids:
+    return
+
+  bump_version(Change.__tablename__)
+  now = datetime.utcnow()
+  db.session.execute(Change.__table__.insert(), [
+    {'table_name': table_name, 'row_id': row_id, 'op': op, 'changed_at': now}
+    for row_id in row_ids])
+
+
+'''
+ChangesCompactedError Exception
+    raised when the change log entries a client asks for were compacted
+    head is the latest seq, where a client that fetched everything again
+    picks up the log
+'''
+class ChangesCompactedError(Exception):
+  def __init__(self, since, head):
+    super().__init__(since, head)
+    self.since = since
+    self.head = head
+
+
+'''
+changes_since(since, limit)
+    up to limit change log entries after seq since, oldest first
+    raises ChangesCompactedError, with the head seq, if entries after since
+    were compacted
+'''
+def changes_since(since, limit):
+  compacted = get_versions(COMPACTED_CHANGES)[0]
+  if since < compacted:
+    head = db.session.query(func.max(Change.seq)).scalar()
+    raise ChangesCompactedError(since, head or compacted)
+
+  return Change.query.filter(Change.seq > since).order_by(
+    Change.seq).limit(limit).all()
+
+
+'''
+compact_changes(retention_days)
+    drops the change log entries older than the retention window and 
+    records the last dropped seq, so clients asking for changes since an
+    earlier seq know to resync
+    returns the number of dropped entries
+'''
+def compact_changes(retention_days=CHANGE_RETENTION_DAYS):
+  cutoff = datetime.utcnow() - timedelta(days=retention_days)
+  last = db.session.query(func.max(Change.seq)).filter(
+    Change.changed_at < cutoff).scalar()
+  if last is None:
+    return 0
+
+  try:
+    dropped = Change.query.filter(Change.seq <= last).delete(
+      synchronize_session=False)
+    table = TableVersion.__table__
+    if not db.session.execute(table.update()
+                              .where(table.c.name == COMPACTED_CHANGES)
+                              .values(version=last)).rowcount:
+      db.session.execute(table.insert().values(name=COMPACTED_CHANGES,
+                                               version=last))
+    db.session.commit()
+  except SQLAlchemyError:
+    db.session.rollback()
+    raise
+
+  return dropped
+
+
+'''
+castings association table
+    links movies and actors, indexed both ways: the primary key covers
+    lookups by movie_id, ix_castings_actor_id lookups by actor_id
+'''
+castings = db.Table('castings',
+  Column('movie_id', db.Integer,
+         db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+  Column('actor_id', db.Integer,
+         db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+  db.Index('ix_castings_actor_id', 'actor_id')
+)
+
+
+'''
+Full-text search over movie titles and actor names
+    postgresql: GIN indexes on to_tsvector('simple', ...) expressions,
+        kept in sync by the database itself
+    sqlite: FTS5 tables movies_fts(title) and actors_fts(name) whose rowid
+        is the entity id, kept in sync by the write paths below
+    other databases fall back to an unindexed LIKE scan
+'''
+SEARCH_COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+
+def _dialect_name():
+  return db.session.get_bind().dialect.name
+
+
+def create_search_index():
+  dialect = _dialect_name()
+  for table, column in SEARCH_COLUMNS.items():
+    if dialect == 'postgresql':
+      db.session.execute(text(
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_tsv ON {table} "
+        f"USING gin (to_tsvector('simple', coalesce({column}, '')))"))
+    elif dialect == 'sqlite':
+      db.session.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({column})"))
+  db.session.commit()
+
+
+def rebuild_search_index():
+  dialect = _dialect_name()
+  for table, column in SEARCH_COLUMNS.items():
+    if dialect == 'postgresql':
+      db.session.execute(text(f"REINDEX INDEX ix_{table}_{column}_tsv"))
+    elif dialect == 'sqlite':
+      db.session.execute(text(f"DELETE FROM {table}_fts"))
+      db.session.execute(text(
+        f"INSERT INTO {table}_fts (rowid, {column}) "
+        f"SELECT id, {column} FROM {table}"))
+    # cached search responses were built from the old index
+    bump_version(table)
+  db.session.commit()
+
+
+'''
+sync_search_index(table, rows, deleted_ids)
+    (re)indexes (id, text) rows and drops deleted ids, in the current
+    transaction; only the sqlite FTS5 tables need it
+'''
+def sync_search_index(table, rows=(), deleted_ids=()):
+  if _dialect_name() != 'sqlite':
+    return
+
+  column = SEARCH_COLUMNS[table]
+  stale = [{'id': row_id} for row_id in deleted_ids]
+  stale += [{'id': row_id} for row_id, _ in rows]
+  if stale:
+    db.session.execute(
+      text(f"DELETE FROM {table}_fts WHERE rowid = :id"), stale)
+  if rows:
+    db.session.execute(
+      text(f"INSERT INTO {table}_fts (rowid, {column}) VALUES (:id, :text)"),
+      [{'id': row_id, 'text': value} for row_id, value in rows])
+
+
+'''
+search(terms, limit, offset)
+    ranked matches of every term (as a prefix) across movie titles and
+    actor names, returns (table, id) pairs, best match first
+'''
+def search(terms, limit, offset):
+  words = re.findall(r'\w+', terms.lower())
+  if not words:
+    return []
+
+  dialect = _dialect_name()
+  params = {'limit': limit, 'offset': offset}
+  arms = []
+  if dialect == 'postgresql':
+    params['query'] = ' & '.join(word + ':*' for word in words)
+    for table, column in SEARCH_COLUMNS.items():
+      vector = f"to_tsvector('simple', coalesce({column}, ''))"
+      arms.append(
+        f"SELECT '{table}' AS kind, id, -ts_rank({vector}, query) AS rank "
+        f"FROM {table}, to_tsquery('simple', :query) query "
+        f"WHERE {vector} @@ query")
+  elif dialect == 'sqlite':
+    params['query'] = ' '.join(f'"{word}"*' for word in words)
+    for table in SEARCH_COLUMNS:
+      arms.append(
+        f"SELECT '{table}' AS kind, rowid AS id, bm25({table}_fts) AS rank "
+        f"FROM {table}_fts WHERE {table}_fts MATCH :query")
+  else:
+    for i, word in enumerate(words):
+      params[f'word{i}'] = f'%{word}%'
+    for table, column in SEARCH_COLUMNS.items():
+      matches = ' AND '.join(f'lower({column}) LIKE :word{i}'
+                             for i in range(len(words)))
+      arms.append(
+        f"SELECT '{table}' AS kind, id, 0 AS rank FROM {table} WHERE {matches}")
+
+  # lower rank is a better match in every branch
+  statement = (' UNION ALL '.join(arms) +
+               ' ORDER BY rank, kind, id LIMIT :limit OFFSET :offset')
+  return [(row.kind, row.id)
+          for row in db.session.execute(text(statement), params)]
+
+
+'''
+StaleVersionError Exception
+    raised when a write expected a row version that is no longer current
+'''
+class StaleVersionError(Exception):
+  pass
+
+
+def _supports_returning():
+  return db.session.get_bind().dialect.implicit_returning
+
+
+def _exists(model, row_id):
+  table = model.__table__
+  return db.session.execute(
+    table.select().with_only_columns([table.c.id])
+      .where(table.c.id == row_id)).first() is not None
+
+
+'''
+update_row(model, row_id, values, expected_version=None)
+    a single UPDATE ... SET ..., version = version + 1 ... RETURNING, so
+    there is no read before the write and no lost update: when
+    expected_version is given the row is only changed if it still has it
+    returns the updated row, None if there is no such row, and raises
+    StaleVersionError if expected_version is stale
+'''
+def update_row(model, row_id, values, expected_version=None):
+  table = model.__table__
+  condition = table.c.id == row_id
+  if expected_version is not None:
+    condition = and_(condition, table.c.version == expected_version)
+  statement = (table.update().where(condition)
+               .values(version=table.c.version + 1, **values))
+
+  try:
+    if _supports_returning():
+      row = db.session.execute(statement.returning(*table.c)).first()
+    else:
+      # no RETURNING (e.g. sqlite): read the row back in the same transaction
+      row = None
+      if db.session.execute(statement).rowcount:
+        row = db.session.execute(
+          table.select().where(table.c.id == row_id)).first()
+
+    if row is None:
+      db.session.rollback()
+      if expected_version is not None and _exists(model, row_id):
+        raise StaleVersionError(row_id)
+      return None
+
+    column = SEARCH_COLUMNS[table.name]
+    sync_search_index(table.name, [(row.id, row[column])])
+    log_changes(table.name, 'update', [row.id])
+    bump_version(table.name)
+    db.session.commit()
+  except SQLAlchemyError:
+    db.session.rollback()
+    raise
+
+  return row
+
+
+'''
+delete_row(model, row_id, expected_version=None)
+    a single DELETE ... RETURNING id, with the same version check as
+    update_row; the row's castings go in the same transaction
+    returns True if the row was deleted, False if there is no such row
+'''
+def delete_row(model, row_id, expected_version=None):
+  table = model.__table__
+  condition = table.c.id == row_id
+  if expected_version is not None:
+    condition = and_(condition, table.c.version == expected_version)
+  statement = table.delete().where(condition)
+
+  try:
+    if _supports_returning():
+      deleted = db.session.execute(statement.returning(table.c.id)).first()
+    else:
+      deleted = db.session.execute(statement).rowcount
+
+    if not deleted:
+      db.session.rollback()
+      if expected_version is not None and _exists(model, row_id):
+        raise StaleVersionError(row_id)
+      return False
+
+    cast_column = castings.c.movie_id if model is Movie else castings.c.actor_id
+    if db.session.execute(castings.delete().where(cast_column == row_id)).rowcount:
+      bump_version(castings.name)
+    sync_search_index(table.name, deleted_ids=[row_id])
+    log_changes(table.name, 'delete', [row_id])
+    bump_version(table.name, -1)
+    db.session.commit()
+  except SQLAlchemyError:
+    db.session.rollback()
+    raise
+
+  return True
+
+
+'''
+update_rows(model, updates)
+    applies a list of {'id': ..., column: value} updates in one transaction:
+    the existing ids are locked with one SELECT ... FOR UPDATE, then every
+    group of updates touching the same columns runs as one executemany
+    returns the updated ids and the missing ones
+'''
+def update_rows(model, updates):
+  table = model.__table__
+  ids = {update['id'] for update in updates}
+
+  try:
+    existing = {row.id for row in db.session.execute(
+      table.select().with_only_columns([table.c.id])
+        .where(table.c.id.in_(ids)).with_for_update())}
+
+    groups = {}
+    for update in updates:
+      if update['id'] in existing:
+        columns = tuple(sorted(c for c in update if c != 'id'))
+        groups.setdefault(columns, []).append(update)
+
+    for columns, group in groups.items():
+      statement = (table.update()
+                   .where(table.c.id == bindparam('_id'))
+                   .values(version=table.c.version + 1,
+                           **{c: bindparam(c) for c in columns}))
+      db.session.execute(statement, [
+        dict({c: update[c] for c in columns}, _id=update['id'])
+        for update in group])
+
+    column = SEARCH_COLUMNS[table.name]
+    sync_search_index(table.name, [
+      (update['id'], update[column]) for update in updates
+      if update['id'] in existing and column in update])
+    if existing:
+      log_changes(table.name, 'update', sorted(existing))
+      bump_version(table.name)
+    db.session.commit()
+  except SQLAlchemyError:
+    db.session.rollback()
+    raise
+
+  return sorted(existing), sorted(ids - existing)
+
+
+'''
+delete_rows(model, ids)
+    deletes the rows with the given ids, and their castings, in one
+    transaction with set-based DELETE ... WHERE id IN (...) statements
+    returns the deleted ids and the missing ones
+'''
+def delete_rows(model, ids):
+  table = model.__table__
+  ids = set(ids)
+  statement = table.delete().where(table.c.id.in_(ids))
+
+  try:
+    if _supports_returning():
+      deleted = {row.id for row in
+                 db.session.execute(statement.returning(table.c.id))}
+    else:
+      deleted = {row.id for row in db.session.execute(
+        table.select().with_only_columns([table.c.id])
+          .where(table.c.id.in_(ids)))}
+      db.session.execute(statement)
+
+    if deleted:
+      cast_column = castings.c.movie_id if model is Movie else castings.c.actor_id
+      if db.session.execute(
+          castings.delete().where(cast_column.in_(deleted))).rowcount:
+        bump_version(castings.name)
+      sync_search_index(table.name, deleted_ids=deleted)
+      log_changes(table.name, 'delete', sorted(deleted))
+      bump_version(table.name, -len(deleted))
+    db.session.commit()
+  except SQLAlchemyError:
+    db.session.rollback()
+    raise
+
+  return sorted(deleted), sorted(ids - deleted)
 
 
 '''
 Movie Class
-Have Attributes: title and release year
+Have Attributes: title, release year and version
+Have Relationship: actors (the cast), backref movies on Actor
 '''
 class Movie(db.Model):  
   __tablename__ = 'movies'
 
+  # the fields of format(), in order
+  FIELDS = ('id', 'title', 'release_date')
+
   id = Column(db.Integer, primary_key=True)
   title = Column(String)
-  release_date = Column(String)
+  release_date = Column(Date)
+  version = Column(db.Integer, nullable=False, server_default='1')
+  actors = db.relationship('Actor', secondary=castings, order_by='Actor.id',
+                           backref=db.backref('movies', order_by='Movie.id'))
+
+  # optimistic concurrency for the orm write paths as well
+  __mapper_args__ = {'version_id_col': version}
+  # the sorts page through (column, id), forwards or backwards
+  __table_args__ = (
+    db.Index('ix_movies_title', 'title', 'id'),
+    db.Index('ix_movies_release_date', 'release_date', 'id'),
+  )
 
   def __init__(self, title, release_date):
     self.title = title
-    self.release_date = release_date
+    self.release_date = parse_date(release_date)
+
+  @staticmethod
+  def values(record, partial=False):
+    values = {}
+    if not partial or 'title' in record:
+      values['title'] = record['title']
+    if not partial or 'release_date' in record:
+      values['release_date'] = parse_date(record['release_date'])
+    return values
 
   def format(self):
     return {
       'id': self.id,
       'title': self.title,
-      'release_date': self.release_date
+      'release_date': format_date(self.release_date)
     }
 
+  def format_with_cast(self):
+    movie = self.format()
+    movie['actors'] = [actor.format() for actor in self.actors]
+    return movie
+
+  def add_actor(self, actor):
+    if actor not in self.actors:
+      self.actors.append(actor)
+    bump_version(castings.name)
+    db.session.commit()
+
+  def remove_actor(self, actor):
+    self.actors.remove(actor)
+    bump_version(castings.name)
+    db.session.commit()
+
   def insert(self):
     db.session.add(self)
+    db.session.flush()
+    sync_search_index(self.__tablename__, [(self.id, self.title)])
+    log_changes(self.__tablename__, 'insert', [self.id])
+    bump_version(self.__tablename__, 1)
     db.session.commit()
   
   def update(self):
+    sync_search_index(self.__tablename__, [(self.id, self.title)])
+    log_changes(self.__tablename__, 'update', [self.id])
+    bump_version(self.__tablename__)
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    sync_search_index(self.__tablename__, deleted_ids=[self.id])
+    log_changes(self.__tablename__, 'delete', [self.id])
+    bump_version(self.__tablename__, -1)
     db.session.commit()
 
 
 '''
 Actor Class
-Have Attributes: name, age and gender
+Have Attributes: name, age, gender and version
 '''
 class Actor(db.Model):  
   __tablename__ = 'actors'
 
+  # the fields of format(), in order
+  FIELDS = ('id', 'name', 'age', 'gender')
+
   id = Column(db.Integer, primary_key=True)
   name = Column(String)
   age = Column(db.Integer)
-  gender = Column(String)
+  gender = Column(String, index=True)
+  version = Column(db.Integer, nullable=False, server_default='1')
+
+  # optimistic concurrency for the orm write paths as well
+  __mapper_args__ = {'version_id_col': version}
+  # the age sort pages through (age, id), forwards or backwards
+  __table_args__ = (db.Index('ix_actors_age', 'age', 'id'),)
 
   def __init__(self, name, age, gender):
     self.name = name
     self.age = age
     self.gender = gender
 
+  @staticmethod
+  def values(record, partial=False):
+    return {f: record[f] for f in ('name', 'age', 'gender')
+            if not partial or f in record}
+
   def insert(self):
     db.session.add(self)
+    db.session.flush()
+    sync_search_index(self.__tablename__, [(self.id, self.name)])
+    log_changes(self.__tablename__, 'insert', [self.id])
+    bump_version(self.__tablename__, 1)
     db.session.commit()
   
   def update(self):
+    sync_search_index(self.__tablename__, [(self.id, self.name)])
+    log_changes(self.__tablename__, 'update', [self.id])
+    bump_version(self.__tablename__)
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    sync_search_index(self.__tablename__, deleted_ids=[self.id])
+    log_changes(self.__tablename__, 'delete', [self.id])
+    bump_version(self.__tablename__, -1)
     db.session.commit()
 
   def format(self):
@@ -89,4 +1083,198 @@ class Actor(db.Model):
       'name': self.name,
       'age': self.age,
       'gender': self.gender
-    }
\ No newline at end of file
+    }
+
+  def format_with_movies(self):
+    actor = self.format()
+    actor['movies'] = [movie.format() for movie in self.movies]
+    return actor
+
+
+'''
+bulk_insert(model, rows, atomic=True)
+    writes a list of column dicts chunk by chunk, using one multi-row
+    INSERT ... RETURNING id per chunk where the database supports it
+    - atomic: a single transaction, any failure rolls everything back
+        and is raised
+    - partial: each chunk runs in a savepoint, and a failing chunk is
+        retried row by row so only the offending rows are rejected
+    returns, for each row in order, its new id or the database error
+'''
+def bulk_insert(model, rows, atomic=True):
+  results = []
+  try:
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+      chunk = rows[start:start + BULK_INSERT_CHUNK_SIZE]
+      if atomic:
+        results.extend(_insert_rows(model, chunk))
+        continue
+
+      try:
+        with db.session.begin_nested():
+          results.extend(_insert_rows(model, chunk))
+      except SQLAlchemyError:
+        for row in chunk:
+          try:
+            with db.session.begin_nested():
+              results.extend(_insert_rows(model, [row]))
+          except SQLAlchemyError as e:
+            results.append(e)
+
+    column = SEARCH_COLUMNS[model.__tablename__]
+    sync_search_index(model.__tablename__,
+                      [(row_id, row[column]) for row_id, row in zip(results, rows)
+                       if not isinstance(row_id, Exception)])
+    inserted = [row_id for row_id in results if not isinstance(row_id, Exception)]
+    log_changes(model.__tablename__, 'insert', inserted)
+    bump_version(model.__tablename__, len(inserted))
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+
+  return results
+
+
+def _insert_rows(model, rows):
+  table = model.__table__
+  dialect = db.session.get_bind().dialect
+
+  if dialect.implicit_returning and dialect.supports_multivalues_insert:
+    result = db.session.execute(
+      table.insert().values(rows).returning(table.c.id))
+    return [row[0] for row in result]
+
+  # no RETURNING (e.g. sqlite): one statement per row, same transaction
+  return [db.session.execute(table.insert(), row).inserted_primary_key[0]
+          for row in rows]
+
+
+'''
+load_rows(model, records, batch_size, drop_indexes, progress)
+    loads an iterable of records (dicts of the model fields, as strings or
+    typed values) in one transaction, batch_size rows at a time: COPY FROM
+    STDIN on postgres, one executemany per batch elsewhere, so memory stays
+    bounded by one batch however long the input is
+    - drop_indexes drops the secondary indexes of the table during the 
+        load and rebuilds them once at the end
+    - progress(loaded) is called after every batch
+    the search index, change log and row count catch up with set-based
+    statements over the new ids; a bad record raises ValueError naming its 
+    position, and nothing is loaded
+    returns the number of loaded rows
+'''
+def load_rows(model, records, batch_size=LOAD_BATCH_SIZE, drop_indexes=False,
+              progress=None):
+  table = model.__table__
+  fields = [f for f in model.FIELDS if f != 'id']
+  dialect = _dialect_name()
+  last_id = db.session.query(func.max(model.id)).scalar() or 0
+  loaded = 0
+
+  try:
+    if dialect == 'postgresql':
+      # DB_STATEMENT_TIMEOUT_MS is meant for the api, not for bulk loads
+      db.session.execute(text("SET LOCAL statement_timeout = 0"))
+    dropped = _drop_indexes(table, dialect) if drop_indexes else []
+
+    batch = []
+    for position, record in enumerate(records, 1):
+      try:
+        batch.append(_load_values(model, record))
+      except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid record {position}: {e!r}')
+
+      if len(batch) == batch_size:
+        _load_batch(table, fields, batch, dialect)
+        loaded += len(batch)
+        batch = []
+        if progress:
+          progress(loaded)
+
+    if batch:
+      _load_batch(table, fields, batch, dialect)
+      loaded += len(batch)
+      if progress:
+        progress(loaded)
+
+    if loaded:
+      _catch_up(table, last_id, dialect)
+      bump_version(table.name, loaded)
+    for index in dropped:
+      index.create(bind=db.session.connection())
+    if drop_indexes and dialect == 'postgresql':
+      create_search_index()
+    db.session.commit()
+  except:
+    db.session.rollback()
+    raise
+
+  return loaded
+
+
+def _load_values(model, record):
+  values = model.values(record)
+  for name, value in values.items():
+    if isinstance(value, str) and isinstance(model.__table__.c[name].type,
+                                             db.Integer):
+      values[name] = int(value) if value.strip() else None
+  return values
+
+
+def _load_batch(table, fields, rows, dialect):
+  if dialect != 'postgresql':
+    db.session.execute(table.insert(), rows)
+    return
+
+  # csv format: unquoted empty fields are NULL
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  for row in rows:
+    writer.writerow([row[f] for f in fields])
+  buffer.seek(0)
+
+  cursor = db.session.connection().connection.cursor()
+  try:
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(fields)}) "
+                       f"FROM STDIN WITH (FORMAT csv)", buffer)
+  finally:
+    cursor.close()
+
+
+def _drop_indexes(table, dialect):
+  connection = db.session.connection()
+  dropped = list(table.indexes)
+  for index in dropped:
+    index.drop(bind=connection)
+  if dialect == 'postgresql' and table.name in SEARCH_COLUMNS:
+    db.session.execute(text(
+      f"DROP INDEX IF EXISTS ix_{table.name}_{SEARCH_COLUMNS[table.name]}_tsv"))
+  return dropped
+
+
+def _catch_up(table, last_id, dialect):
+  column = SEARCH_COLUMNS[table.name]
+  if dialect == 'sqlite':
+    db.session.execute(text(
+      f"INSERT INTO {table.name}_fts (rowid, {column}) "
+      f"SELECT id, {column} FROM {table.name} WHERE id > :last_id"),
+      {'last_id': last_id})
+
+  bump_version(Change.__tablename__)
+  db.session.execute(text(
+    f"INSERT INTO {Change.__tablename__} (table_name, row_id, op, changed_at) "
+    f"SELECT :table_name, id, 'insert', :now FROM {table.name} "
+    f"WHERE id > :last_id ORDER BY id"),
+    {'table_name': table.name, 'now': datetime.utcnow(), 'last_id': last_id})
+
+
+'''
+dump_rows(model, batch_size)
+    streams every row of the model, in id order, as format() dicts read 
+    batch_size rows at a time through a server-side cursor
+'''
+def dump_rows(model, batch_size=LOAD_BATCH_SIZE):
+  query = db.session.query(*[getattr(model, f) for f in model.FIELDS])
+  for row in query.order_by(model.id).yield_per(batch_size):
+    yield format_row(model, row, model.FIELDS)
@@ -0,0 +1,134 @@
+import os
+import re
+import time
+import random
+import cProfile
+import tempfile
+import threading
+from flask import request
+
+from auth import (AuthError, get_token_auth_header, verify_decode_jwt,
+                  check_permissions)
+
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PERMISSION = 'admin:profile'
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 100))
+PROFILE_DIR = os.environ.get(
+    'PROFILE_DIR',
+    os.path.join(tempfile.gettempdir(), 'casting-agency-profiles'))
+
+PROFILE_ENVIRON_KEY = 'casting_agency.profile'
+
+'''
+Request profiler
+    runs cProfile over a PROFILE_SAMPLE_RATE share of the requests, and
+    over any request with an X-Profile header whose token has the
+    admin:profile permission, and writes each profile as a pstats file
+    (python -m pstats, snakeviz, ...) in PROFILE_DIR, keeping the newest
+    PROFILE_KEEP
+    cProfile only sees the thread that enables it, and one profile runs per
+    thread at a time (a POST /batch is profiled as a whole)
+'''
+
+_active = threading.local()
+
+
+'''
+wants_profile()
+    whether the current request is sampled or asked for a profile; the
+    header of a token without admin:profile is ignored
+'''
+def wants_profile():
+    if PROFILE_HEADER in request.headers:
+        try:
+            check_permissions(PROFILE_PERMISSION,
+                              verify_decode_jwt(get_token_auth_header()))
+            return True
+        except AuthError:
+            pass
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+'''
+list_profiles() / profile_path(name)
+    the saved profiles, newest first, and the path of one of them (None if
+    there is no such profile)
+'''
+PROFILE_NAME = re.compile(r'^[\w.-]+\.prof$')
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    profiles = []
+    for entry in os.scandir(PROFILE_DIR):
+        if PROFILE_NAME.match(entry.name):
+            stat = entry.stat()
+            profiles.append({'name': entry.name, 'size': stat.st_size,
+                             'created': stat.st_mtime})
+    return sorted(profiles, key=lambda p: p['created'], reverse=True)
+
+
+def profile_path(name):
+    path = os.path.join(PROFILE_DIR, name)
+    if not PROFILE_NAME.match(name) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def _save(profile, route, duration):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^\w]+', '_', route).strip('_') or 'root'
+    name = '%d-%s-%s-%dms.prof' % (time.time() * 1000, request.method, slug,
+                                   duration * 1000)
+    profile.dump_stats(os.path.join(PROFILE_DIR, name))
+
+    for old in list_profiles()[PROFILE_KEEP:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old['name']))
+        except OSError:
+            pass
+    return name
+
+
+'''
+install(app)
+    hooks the profiler into every request of the app; a profiled response
+    names its profile in an X-Profile-Id header
+'''
+def install(app):
+    @app.before_request
+    def start_profile():
+        if getattr(_active, 'profile', None) is not None or not wants_profile():
+            return
+
+        profile = cProfile.Profile()
+        _active.profile = profile
+        request.environ[PROFILE_ENVIRON_KEY] = (profile, time.perf_counter())
+        profile.enable()
+
+    @app.after_request
+    def save_profile(response):
+        started = request.environ.pop(PROFILE_ENVIRON_KEY, None)
+        if started is None:
+            return response
+
+        profile, start = started
+        profile.disable()
+        _active.profile = None
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        name = _save(profile, route, time.perf_counter() - start)
+        response.headers['X-Profile-Id'] = name
+        return response
+
+    @app.teardown_request
+    def stop_profile(error):
+        # the request failed before after_request could save it
+        started = request.environ.pop(PROFILE_ENVIRON_KEY, None)
+        if started is not None:
+            started[0].disable()
+            _active.profile = None
@@ -1,10 +1,67 @@
 import os
+import sys
 import unittest
 import json
+import tempfile
+import time
+import shutil
+import sqlite3
+import subprocess
+import threading
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import Pool
+from sqlalchemy.engine.url import make_url
+from Crypto.PublicKey import RSA
+from jose import jwt
+from jose.utils import base64url_encode
 
+import auth
+import cache
+import metrics
+import models
+import benchmark
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import setup_db, create_schema, load_rows, dump_rows, Movie, Actor
+
+
+'''
+Helpers for signing tokens with a locally generated RSA key,
+so the auth layer can be tested without Auth0
+'''
+def _b64_int(value):
+    return base64url_encode(
+        value.to_bytes((value.bit_length() + 7) // 8, 'big')).decode()
+
+def make_jwk(kid, key):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+            'n': _b64_int(key.n), 'e': _b64_int(key.e)}
+
+def write_jwks(path, *jwks):
+    with open(path, 'w') as f:
+        json.dump({'keys': list(jwks)}, f)
+
+def sign_token(kid, key, permissions, expires_in=3600):
+    now = int(time.time())
+    claims = {
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'aud': auth.API_AUDIENCE,
+        'sub': 'local|test',
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions
+    }
+    return jwt.encode(claims, key.export_key().decode(), algorithm='RS256',
+                      headers={'kid': kid})
+
+
+'''
+The tables are created once for all the tests, as manage.py create_db does
+'''
+def setUpModule():
+    create_app()
+    create_schema()
 
 
 '''
@@ -42,7 +99,109 @@ class MovieTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+
+    def test_get_movies_filtered(self):
+        # movies released in a date range, latest first
+        res = self.client().get('/movies?sort=-release_date'
+                                '&release_date_from=2000-01-01'
+                                '&release_date_to=12/31/2030',
+                                headers=self.EX_PROD_HEADER)
+        self.assertIn(res.status_code, (200, 404))
+
+        if res.status_code == 200:
+            dates = [datetime.strptime(m['release_date'], '%m/%d/%Y')
+                     for m in json.loads(res.data)['movies']]
+            self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_get_movies_counts(self):
+        # the exact and the cached count agree, the estimate is close
+        totals = []
+        for mode in ('exact', 'estimate', 'cached'):
+            res = self.client().get('/movies?per_page=5&count=' + mode,
+                                    headers=self.EX_PROD_HEADER)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['page_count'], -(-data['total'] // 5))
+            self.assertEqual(data['has_next'], data['total'] > 5)
+            totals.append(data['total'])
+
+        self.assertEqual(totals[0], totals[2])
+
+    def test_load_movies(self):
+        # bulk loaded rows are searchable and dumped like the api formats them
+        title = 'Bulkloaded Picture %d' % time.time()
+        records = [{'title': title, 'release_date': '2001-02-03'},
+                   {'title': title, 'release_date': '02/03/2001'}]
+        self.assertEqual(load_rows(Movie, iter(records), batch_size=1), 2)
+
+        res = self.client().get('/search?q=Bulkloaded', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(title, [r.get('title') for r in json.loads(res.data)['results']])
+        dumped = [m for m in dump_rows(Movie) if m['title'] == title]
+        self.assertEqual([m['release_date'] for m in dumped],
+                         ['02/03/2001', '02/03/2001'])
+
+    def test_get_movies_cursor(self):
+        # walk to the next page with the keyset cursor
+        res = self.client().get('/movies?per_page=1', headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+
+        if data['next_cursor'] is not None:
+            res = self.client().get('/movies?per_page=1&cursor=' + data['next_cursor'],
+                                    headers=self.EX_PROD_HEADER)
+            next_page = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertGreater(next_page['movies'][0]['id'], data['movies'][0]['id'])
         
+    def test_get_movies_sorted_cursor(self):
+        # cursors and pages agree on the (release_date, id) order, NULLs last
+        title = 'Sorted Picture %d' % time.time_ns()
+        dates = ['2001-01-01', None, '2003-01-01', None, '2001-01-01']
+        movies = []
+        for release_date in dates:
+            movie = Movie(title, release_date or '2000-01-01')
+            if release_date is None:
+                movie.release_date = None
+            movie.insert()
+            movies.append((movie.id, release_date))
+
+        for sort, descending in (('release_date', False), ('-release_date', True)):
+            dated = sorted([(d, i) for i, d in movies if d], reverse=descending)
+            undated = sorted([i for i, d in movies if not d], reverse=descending)
+            expected = [movie_id for _, movie_id in dated] + undated
+
+            url = '/movies?per_page=2&title=%s&sort=%s' % (title, sort)
+            walked, cursor = [], None
+            while True:
+                data = json.loads(self.client().get(
+                    url + ('&cursor=' + cursor if cursor else ''),
+                    headers=self.EX_PROD_HEADER).data)
+                walked += [m['id'] for m in data['movies']]
+                cursor = data['next_cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(walked, expected)
+
+            paged = []
+            for page in (1, 2, 3):
+                data = json.loads(self.client().get(
+                    url + '&page=%d' % page, headers=self.EX_PROD_HEADER).data)
+                paged += [m['id'] for m in data['movies']]
+            self.assertEqual(paged, expected)
+
+        for movie_id, _ in movies:
+            self.client().delete('/movies/%d' % movie_id, headers=self.EX_PROD_HEADER)
+
+    def test_get_movies_sparse_fields(self):
+        # only the requested fields are selected and returned
+        res = self.client().get('/movies?fields=title', headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertTrue(all(list(m) == ['title'] for m in data['movies']))
+
     def test_create_movie(self):
         # first create and post new movie and test
         new_movie = {
@@ -56,6 +215,77 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    def test_get_movies_not_modified(self):
+        # a matching If-None-Match returns 304 with no body
+        res = self.client().get('/movies', headers=self.EX_PROD_HEADER)
+        etag = res.headers['ETag']
+
+        headers = dict(self.EX_PROD_HEADER, **{'If-None-Match': etag})
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_export_movies(self):
+        # stream all movies as ndjson
+        res = self.client().get('/movies/export', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        for line in res.data.decode('utf-8').splitlines():
+            self.assertIn('title', json.loads(line))
+
+    def test_create_movies_bulk(self):
+        # create several movies in one request
+        new_movies = {
+            "movies": [
+                {"title": "Bulk One", "release_date": "01/01/2024"},
+                {"title": "Bulk Two", "release_date": "02/01/2024"}
+            ]
+        }
+        res = self.client().post('/movies/bulk', 
+                                headers=self.EX_PROD_HEADER,
+                                json=new_movies)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertTrue(all('id' in m for m in data['movies']))
+
+    def test_assign_actor(self):
+        # cast a new actor in a new movie and read the cast back
+        new_movie = {"title": "Cast", "release_date": "01/01/2024"}
+        movie = json.loads(self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                                              json=new_movie).data)['movie']
+        new_actor = {"name": "Cast Member", "age": 30, "gender": "female"}
+        actor = json.loads(self.client().post('/actors', headers=self.EX_PROD_HEADER,
+                                              json=new_actor).data)['actor']
+
+        res = self.client().post('/movies/%d/actors/%d' % (movie['id'], actor['id']),
+                                headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/movies?include=cast', headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all('actors' in m for m in data['movies']))
+
+        res = self.client().get('/movies/%d/actors' % movie['id'],
+                                headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertIn(actor['id'], [a['id'] for a in data['actors']])
+
+        self.client().delete('/movies/%d' % movie['id'], headers=self.EX_PROD_HEADER)
+        self.client().delete('/actors/%d' % actor['id'], headers=self.EX_PROD_HEADER)
+
+    def test_search(self):
+        # a new movie is found by a prefix of its title
+        new_movie = {"title": "Searchable Zyzzyva", "release_date": "01/01/2024"}
+        self.client().post('/movies', headers=self.EX_PROD_HEADER, json=new_movie)
+
+        res = self.client().get('/search?q=zyzz', headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(('movie', 'Searchable Zyzzyva'),
+                      [(r['type'], r.get('title')) for r in data['results']])
+
     def test_update_movie(self):
         # update a movie and test
         movies = json.loads(self.client().get('/movies', 
@@ -74,6 +304,23 @@ class MovieTestCase(unittest.TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertTrue(data['success'])
 
+    def test_update_movie_partial(self):
+        # update only the title of a movie, conditional on its version
+        movies = json.loads(self.client().get('/movies', 
+                                headers=self.EX_PROD_HEADER).data)["movies"]
+        a_movie = movies[0]
+        etag = self.client().get('/movies/' + str(a_movie['id']),
+                                 headers=self.EX_PROD_HEADER).headers['ETag']
+
+        headers = dict(self.EX_PROD_HEADER, **{'If-Match': etag})
+        res = self.client().patch('/movies/' + str(a_movie['id']),
+                                  headers=headers, json={"title": "Partial"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated_movie']['title'], 'Partial')
+        self.assertEqual(data['updated_movie']['release_date'], a_movie['release_date'])
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     def test_delete_movie(self):
         # delete a movie and test
         movies = json.loads(self.client().get('/movies',
@@ -86,13 +333,189 @@ class MovieTestCase(unittest.TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertTrue(data['success'])
 
+    def test_batch_update_and_delete_movies(self):
+        # re-title and then delete two new movies in batch
+        new_movies = {
+            "movies": [
+                {"title": "Batch One", "release_date": "01/01/2024"},
+                {"title": "Batch Two", "release_date": "02/01/2024"}
+            ]
+        }
+        created = json.loads(self.client().post('/movies/bulk',
+                                headers=self.EX_PROD_HEADER,
+                                json=new_movies).data)['movies']
+        ids = [m['id'] for m in created]
+
+        res = self.client().patch('/movies/batch', headers=self.EX_PROD_HEADER,
+                                  json={"movies": [{"id": i, "title": "Batch"} for i in ids]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], sorted(ids))
+
+        res = self.client().delete('/movies?ids=%d,%d,10000000' % tuple(ids),
+                                   headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], sorted(ids))
+        self.assertEqual(data['missing'], [10000000])
+
+    def test_batch_requests(self):
+        # a page of movies and a new movie in one round trip
+        batch = {
+            "requests": [
+                {"method": "GET", "path": "/movies?per_page=1"},
+                {"method": "POST", "path": "/movies",
+                 "body": {"title": "Batched", "release_date": "03/01/2024"}}
+            ]
+        }
+        res = self.client().post('/batch', headers=self.EX_PROD_HEADER, json=batch)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([r['status'] for r in data['responses']], [200, 200])
+
+        movie_id = data['responses'][1]['body']['movie']['id']
+        self.client().delete('/movies/%d' % movie_id, headers=self.EX_PROD_HEADER)
+
+    def test_get_changes(self):
+        # a new movie shows up in the change feed after the current seq
+        since, changes = 0, True
+        while changes:
+            data = json.loads(self.client().get('/changes?limit=1000&since=%d' % since,
+                                                headers=self.EX_PROD_HEADER).data)
+            since, changes = data['next_since'], data['changes']
+
+        new_movie = {"title": "Feed", "release_date": "04/01/2024"}
+        movie = json.loads(self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                                              json=new_movie).data)['movie']
+
+        res = self.client().get('/changes?since=%d' % since,
+                                headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'type': 'movie', 'id': movie['id'], 'op': 'insert'},
+                      [{k: c[k] for k in ('type', 'id', 'op')} for c in data['changes']])
+
+        self.client().delete('/movies/%d' % movie['id'], headers=self.EX_PROD_HEADER)
+
+    def test_get_changes_after_compaction(self):
+        # a client behind the compacted log gets the head seq and resyncs from it
+        new_movie = {"title": "Compacted", "release_date": "04/01/2024"}
+        movie = json.loads(self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                                              json=new_movie).data)['movie']
+        self.client().delete('/movies/%d' % movie['id'], headers=self.EX_PROD_HEADER)
+        models.compact_changes(retention_days=-1)
+
+        res = self.client().get('/changes?since=1', headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 410)
+        head = data['head']
+
+        res = self.client().get('/changes?since=0', headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['next_since'], head)
+
+        movie = json.loads(self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                                              json=new_movie).data)['movie']
+        res = self.client().get('/changes?since=%d' % head,
+                                headers=self.EX_PROD_HEADER)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(c['id'], c['op']) for c in data['changes']],
+                         [(movie['id'], 'insert')])
+
+        self.client().delete('/movies/%d' % movie['id'], headers=self.EX_PROD_HEADER)
+
+    def test_get_metrics(self):
+        # the movies request shows up in the metrics with its phases
+        self.client().get('/movies', headers=self.EX_PROD_HEADER)
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('casting_agency_requests_total{method="GET",route="/movies",status="200"}',
+                      res.data.decode())
+        self.assertIn('route="/movies",phase="db"', res.data.decode())
+
     #------one test each for error operation---------
 
     def test_get_movies_error(self):
         # test for getting a wrong page 
         res = self.client().get('/movies?page=10', headers=self.EX_PROD_HEADER)
         self.assertEqual(res.status_code, 404)
+
+    def test_get_movies_filtered_error(self):
+        # test for a malformed date filter and an unknown sort column
+        res = self.client().get('/movies?release_date_from=someday',
+                                headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/movies?sort=budget', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_counts_error(self):
+        # test for an unknown count mode
+        res = self.client().get('/movies?count=approximate', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+
+    def test_load_movies_error(self):
+        # test for a bulk load with a bad record, which loads nothing
+        title = 'Rejected Picture %d' % time.time()
+        records = [{'title': title, 'release_date': '2001-02-03'},
+                   {'title': title, 'release_date': 'someday'}]
+        with self.assertRaises(ValueError):
+            load_rows(Movie, records)
+        self.assertEqual([m for m in dump_rows(Movie) if m['title'] == title], [])
+
+    def test_get_movies_cursor_error(self):
+        # test for a cursor that was not issued by the api
+        res = self.client().get('/movies?cursor=not-a-cursor', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+        
+    def test_get_movies_sparse_fields_error(self):
+        # test for a field movies do not have
+        res = self.client().get('/movies?fields=title,budget', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
         
+    def test_batch_requests_error(self):
+        # test for an atomic batch with a failing request: nothing is kept
+        batch = {
+            "atomic": True,
+            "requests": [
+                {"method": "POST", "path": "/movies",
+                 "body": {"title": "Rolled Back", "release_date": "03/01/2024"}},
+                {"method": "PATCH", "path": "/movies/10000000",
+                 "body": {"title": "Missing"}},
+                {"method": "GET", "path": "/movies"}
+            ]
+        }
+        res = self.client().post('/batch', headers=self.EX_PROD_HEADER, json=batch)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['success'])
+        self.assertEqual([r['status'] for r in data['responses']], [200, 404, 424])
+
+        res = self.client().get('/search?q=rolled', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_changes_error(self):
+        # test for a malformed since
+        res = self.client().get('/changes?since=yesterday', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+
+        # and for a wait that is not a finite number
+        for wait in ('nan', 'inf'):
+            res = self.client().get('/changes?wait=' + wait, headers=self.EX_PROD_HEADER)
+            self.assertEqual(res.status_code, 400)
+
+    def test_profile_error(self):
+        # test for the profiling header and endpoint without admin:profile
+        headers = dict(self.EX_PROD_HEADER, **{'X-Profile': '1'})
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Profile-Id', res.headers)
+        res = self.client().get('/admin/profiles', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 401)
+
     def test_create_movie_error(self):
         # test for posting movie with no release data
         new_movie = {
@@ -102,6 +525,35 @@ class MovieTestCase(unittest.TestCase):
                                 json=new_movie)
         self.assertEqual(res.status_code, 400)
 
+    def test_export_movies_error(self):
+        # test for an unsupported export format
+        res = self.client().get('/movies/export?format=xml', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+
+    def test_create_movies_bulk_error(self):
+        # one invalid record fails an atomic bulk request
+        new_movies = {
+            "movies": [
+                {"title": "Bulk One", "release_date": "01/01/2024"},
+                {"title": "Bulk Two"}
+            ]
+        }
+        res = self.client().post('/movies/bulk', headers=self.EX_PROD_HEADER,
+                                json=new_movies)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['movies'][0]['index'], 1)
+
+    def test_search_error(self):
+        # test for a search without terms
+        res = self.client().get('/search?q=', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+
+    def test_assign_actor_error(self):
+        # test for casting an actor in a non existing movie
+        res = self.client().post('/movies/10000/actors/1', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 404)
+
     def test_update_movie_error(self):
         # test for updating non existing movie
         update_move = {
@@ -113,11 +565,34 @@ class MovieTestCase(unittest.TestCase):
                                   json=update_move)
         self.assertEqual(res.status_code, 404)
 
+    def test_update_movie_stale_version_error(self):
+        # test for updating a movie with an outdated If-Match version
+        movies = json.loads(self.client().get('/movies', 
+                                headers=self.EX_PROD_HEADER).data)["movies"]
+        url = '/movies/' + str(movies[0]['id'])
+        etag = self.client().get(url, headers=self.EX_PROD_HEADER).headers['ETag']
+        self.client().patch(url, headers=self.EX_PROD_HEADER, json={"title": "Newer"})
+
+        headers = dict(self.EX_PROD_HEADER, **{'If-Match': etag})
+        res = self.client().patch(url, headers=headers, json={"title": "Older"})
+        self.assertEqual(res.status_code, 412)
+
     def test_delete_movie_error(self):
        # test for deleting non existing movie
         res = self.client().delete('/movies/10000', headers=self.EX_PROD_HEADER)
         self.assertEqual(res.status_code, 404)
 
+    def test_batch_delete_movies_error(self):
+        # test for a batch delete with malformed ids
+        res = self.client().delete('/movies?ids=one,two', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 400)
+
+    def test_batch_update_movies_error(self):
+        # test for a batch update with a boolean id
+        res = self.client().patch('/movies/batch', headers=self.EX_PROD_HEADER,
+                                  json={"movies": [{"id": True, "title": "Title"}]})
+        self.assertEqual(res.status_code, 400)
+
 #-----------------------------------------------------------------
 
 '''
@@ -277,6 +752,424 @@ class UnAuthorizedMovieTestCase(unittest.TestCase):
             self.assertEqual(res.status_code, 401)
 
 
+'''
+Unit Test for the in-process JWKS key store,
+served from a local jwks file instead of Auth0
+'''
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the jwks key store test case"""
+
+    def setUp(self):
+        self.key = RSA.generate(2048)
+        self.jwks_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        self.jwks_file.close()
+        write_jwks(self.jwks_file.name, make_jwk('key-1', self.key))
+
+        self.store = auth.JWKSKeyStore('file://' + self.jwks_file.name,
+                                       ttl=600, min_refresh_interval=600)
+        self.original_store = auth.jwks_store
+        auth.jwks_store = self.store
+        auth.token_cache.clear()
+
+    def tearDown(self):
+        auth.jwks_store = self.original_store
+        auth.token_cache.clear()
+        os.remove(self.jwks_file.name)
+
+    def test_keys_are_fetched_once(self):
+        token = sign_token('key-1', self.key, ['get:movies'])
+        for _ in range(3):
+            payload = auth.verify_decode_jwt(token)
+
+        self.assertEqual(payload['permissions'], ['get:movies'])
+        self.assertEqual(self.store.refresh_count, 1)
+
+    def test_unknown_kid_forces_single_refresh(self):
+        auth.verify_decode_jwt(sign_token('key-1', self.key, []))
+
+        # rotate in a new key: the first unknown kid refreshes the key set
+        write_jwks(self.jwks_file.name, make_jwk('key-1', self.key),
+                   make_jwk('key-2', self.key))
+        auth.verify_decode_jwt(sign_token('key-2', self.key, []))
+        self.assertEqual(self.store.refresh_count, 2)
+
+        # further misses within min_refresh_interval do not refetch
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(sign_token('key-3', self.key, []))
+        self.assertEqual(self.store.refresh_count, 2)
+
+    def test_unparsable_keys_are_skipped(self):
+        write_jwks(self.jwks_file.name,
+                   {'kid': 'key-ec', 'kty': 'EC', 'alg': 'ES999'},
+                   {'kid': 'key-bad', 'kty': 'RSA', 'alg': 'RS256', 'n': '!!'},
+                   make_jwk('key-1', self.key))
+        payload = auth.verify_decode_jwt(sign_token('key-1', self.key, ['get:movies']))
+        self.assertEqual(payload['permissions'], ['get:movies'])
+
+    def test_malformed_key_set_is_an_auth_error(self):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump(['not', 'a', 'key', 'set'], f)
+        with self.assertRaises(auth.AuthError) as raised:
+            auth.verify_decode_jwt(sign_token('key-1', self.key, []))
+        self.assertEqual(raised.exception.status_code, 503)
+
+
+'''
+Unit Test for the verified token cache
+'''
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.key = RSA.generate(2048)
+        self.jwks_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        self.jwks_file.close()
+        write_jwks(self.jwks_file.name, make_jwk('key-1', self.key))
+
+        self.original_store = auth.jwks_store
+        self.original_cache = auth.token_cache
+        auth.jwks_store = auth.JWKSKeyStore('file://' + self.jwks_file.name,
+                                            ttl=600, min_refresh_interval=0)
+        auth.token_cache = auth.TokenCache(maxsize=2)
+
+    def tearDown(self):
+        auth.jwks_store = self.original_store
+        auth.token_cache = self.original_cache
+        os.remove(self.jwks_file.name)
+
+    def test_repeated_token_is_served_from_cache(self):
+        token = sign_token('key-1', self.key, ['get:movies'])
+        first = auth.verify_decode_jwt(token)
+        second = auth.verify_decode_jwt(token)
+
+        self.assertIs(first, second)
+        self.assertEqual(first.permission_set, frozenset(['get:movies']))
+        self.assertTrue(auth.check_permissions('get:movies', second))
+        self.assertEqual(auth.token_cache.stats()['hits'], 1)
+
+    def test_expired_and_evicted_entries(self):
+        auth.token_cache.put('expired', {'exp': time.time() - 1}, 'key-1')
+        self.assertIsNone(auth.token_cache.get('expired'))
+
+        for i in range(3):
+            auth.token_cache.put(str(i), {'exp': time.time() + 60}, 'key-1')
+        self.assertIsNone(auth.token_cache.get('0'))
+        self.assertEqual(auth.token_cache.stats()['evictions'], 1)
+
+    def test_rotated_key_invalidates_entries(self):
+        token = sign_token('key-1', self.key, [])
+        auth.verify_decode_jwt(token)
+
+        # key-1 is retired: the cached payload must not outlive it
+        new_key = RSA.generate(2048)
+        write_jwks(self.jwks_file.name, make_jwk('key-2', new_key))
+        auth.jwks_store.refresh()
+
+        self.assertIsNone(auth.token_cache.get(token))
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(token)
+
+
+'''
+Unit Test for the response cache backends
+'''
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def test_memory_cache_lru_and_ttl(self):
+        memory = cache.MemoryCache(maxsize=2, ttl=60)
+        memory.set('a', b'1')
+        memory.set('b', b'2')
+        memory.get('a')
+        memory.set('c', b'3')
+
+        # b was the least recently used entry
+        self.assertIsNone(memory.get('b'))
+        self.assertEqual(memory.get('a'), b'1')
+        self.assertEqual(memory.stats()['evictions'], 1)
+
+        expiring = cache.MemoryCache(maxsize=2, ttl=0)
+        expiring.set('a', b'1')
+        self.assertIsNone(expiring.get('a'))
+
+    def test_file_cache_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = cache.FileCache(directory, maxsize=10, ttl=60)
+            reader = cache.FileCache(directory, maxsize=10, ttl=60)
+
+            writer.set('/movies?page=1#3', b'{"success": true}')
+            self.assertEqual(reader.get('/movies?page=1#3'), b'{"success": true}')
+            self.assertIsNone(reader.get('/movies?page=1#4'))
+
+    def test_file_cache_ttl_counts_from_the_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for backend in (cache.MemoryCache(maxsize=10, ttl=0.5),
+                            cache.FileCache(directory, maxsize=10, ttl=0.5)):
+                backend.set('/movies?count=estimate', b'{"total": 1}')
+                for _ in range(3):
+                    time.sleep(0.2)
+                    backend.get('/movies?count=estimate')
+                self.assertIsNone(backend.get('/movies?count=estimate'))
+
+    def test_single_flight_coalesces_concurrent_calls(self):
+        flights = cache.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return b'{"success": true}'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flights.do('/movies?page=1', compute)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.stats()['coalesced'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b'{"success": true}'] * 5)
+        self.assertEqual(flights.stats(), {'in_flight': 0, 'leaders': 1,
+                                           'coalesced': 4})
+
+
+'''
+Unit Test for the slow query log
+'''
+class SlowQueryLogTestCase(unittest.TestCase):
+    """This class represents the slow query log test case"""
+
+    def setUp(self):
+        self.threshold_ms = metrics.slow_queries.threshold_ms
+        metrics.slow_queries.clear()
+
+    def tearDown(self):
+        metrics.slow_queries.threshold_ms = self.threshold_ms
+        metrics.slow_queries.clear()
+
+    def test_slow_statements_are_logged_with_their_plan(self):
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+
+        metrics.slow_queries.threshold_ms = 0
+        engine.execute('SELECT name FROM items WHERE id = ?', 1)
+
+        entry = metrics.slow_queries.entries()[-1]
+        self.assertEqual(entry['statement'], 'SELECT name FROM items WHERE id = ?')
+        self.assertTrue(any('items' in line for line in entry['plan']))
+
+        metrics.slow_queries.threshold_ms = -1
+        engine.execute('SELECT name FROM items')
+        self.assertEqual(metrics.slow_queries.entries()[-1], entry)
+
+    def test_failed_statements_leave_no_start_time(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute('SELECT name FROM missing')
+            self.assertEqual(conn.info['casting_agency.query_start'], [])
+
+
+'''
+Unit Test for the read replica routing, against a copy of the database
+standing in for a lagging replica
+'''
+class ReadReplicaTestCase(unittest.TestCase):
+    """This class represents the read replica test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.EX_PROD_HEADER = {
+            "Authorization": "Bearer " + os.getenv("EXECTIVE_PROD_TOKEN")
+        }
+        self.title = 'Primary Only %d' % time.time_ns()
+        self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                           json={'title': 'Replicated', 'release_date': '01/01/2020'})
+
+        self.tmp = tempfile.mkdtemp()
+        replica_path = os.path.join(self.tmp, 'replica.db')
+        shutil.copy(make_url(models.database_url()).database, replica_path)
+        models.replicas.configure([
+            models._create_replica_engine(self.app, 'sqlite:///' + replica_path,
+                                          'replica0')])
+
+    def tearDown(self):
+        models.replicas.configure([])
+        shutil.rmtree(self.tmp)
+
+    def get_movies(self):
+        return self.client().get('/movies?title=' + self.title,
+                                 headers=self.EX_PROD_HEADER)
+
+    def test_get_reads_from_replica(self):
+        # the write goes to the primary, the replica does not have it yet
+        res = self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                                 json={'title': self.title, 'release_date': '01/01/2020'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.get_movies().status_code, 404)
+        self.assertEqual(models.replicas.stats()['reads'], 1)
+
+        res = self.client().get('/metrics', headers=self.EX_PROD_HEADER)
+        self.assertIn('pool_checkout_wait_seconds_count{pool="replica0"}',
+                      res.data.decode())
+
+    def test_get_falls_back_to_primary(self):
+        # an unreachable replica is skipped and the primary answers
+        models.replicas.configure([
+            models._create_replica_engine(
+                self.app, 'sqlite:///' + os.path.join(self.tmp, 'missing', 'x.db'),
+                'replica0')])
+        self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                           json={'title': self.title, 'release_date': '01/01/2020'})
+
+        res = self.get_movies()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['title'] for m in json.loads(res.data)['movies']],
+                         [self.title])
+        self.assertEqual(models.replicas.stats()['replicas_up'], 0)
+        self.assertEqual(models.replicas.stats()['fallbacks'], 1)
+
+    def test_recount_reads_primary(self):
+        # a count missing during a GET is taken from the primary, not the replica
+        reset = "UPDATE table_versions SET row_count = NULL WHERE name = 'movies'"
+        models.db.session.execute(reset)
+        models.db.session.commit()
+        models.replicas.engines[0].execute(reset)
+        self.client().post('/movies', headers=self.EX_PROD_HEADER,
+                           json={'title': self.title, 'release_date': '01/01/2020'})
+
+        res = self.client().get('/movies?count=cached', headers=self.EX_PROD_HEADER)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['total'], Movie.query.count())
+        self.assertEqual(models.row_count('movies'), Movie.query.count())
+
+
+'''
+Unit Test for the app startup
+'''
+class StartupTestCase(unittest.TestCase):
+    """This class represents the startup test case"""
+
+    def test_create_app_does_not_connect(self):
+        checkouts = []
+        def record(*args):
+            checkouts.append(args)
+
+        event.listen(Pool, 'checkout', record)
+        try:
+            create_app()
+        finally:
+            event.remove(Pool, 'checkout', record)
+        self.assertEqual(checkouts, [])
+
+    def test_forked_child_gets_fresh_pools(self):
+        create_app()
+        pool = models.db.engine.pool
+        read, write = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            fresh = models.db.engine.pool is not pool
+            count = models.db.session.query(Movie).count()
+            os.write(write, b'1' if fresh and count >= 0 else b'0')
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 1), b'1')
+        self.assertIs(models.db.engine.pool, pool)
+        os.close(read)
+        os.close(write)
+
+    def test_import_without_database_url(self):
+        env = {k: v for k, v in os.environ.items() if k != 'DATABASE_URL'}
+        script = ('import app, models\n'
+                  'try:\n'
+                  '    models.db.session.query(models.Movie).count()\n'
+                  'except RuntimeError as e:\n'
+                  '    print(e)\n')
+        result = subprocess.run([sys.executable, '-c', script], env=env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), 'DATABASE_URL is not set')
+
+
+'''
+Unit Test for the migrations, run like the release phase against a database
+created by db.create_all() before the migrations were added
+'''
+class MigrationTestCase(unittest.TestCase):
+    """This class represents the migration test case"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'legacy.db')
+        with sqlite3.connect(self.path) as conn:
+            conn.executescript('''
+                CREATE TABLE actors (id INTEGER NOT NULL, name VARCHAR,
+                    age INTEGER, gender VARCHAR, PRIMARY KEY (id));
+                CREATE TABLE movies (id INTEGER NOT NULL, title VARCHAR,
+                    release_date VARCHAR, PRIMARY KEY (id));
+                INSERT INTO movies VALUES (1, 'Legacy', '01/02/2003');
+                INSERT INTO actors VALUES (1, 'Legacy Actor', 40, 'female');
+            ''')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def manage(self, *args):
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + self.path)
+        result = subprocess.run([sys.executable, 'manage.py'] + list(args),
+                                env=env, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def assert_upgraded(self):
+        engine = create_engine('sqlite:///' + self.path)
+        tables = set(engine.table_names())
+        self.assertTrue(set(models.db.metadata.tables) <= tables)
+        self.assertEqual(engine.execute('SELECT release_date FROM movies').scalar(),
+                         '2003-01-02')
+        self.assertEqual(engine.execute(
+            "SELECT row_count FROM table_versions WHERE name = 'actors'").scalar(), 1)
+
+    def test_upgrade_adopts_existing_tables(self):
+        self.manage('db', 'upgrade')
+        self.assert_upgraded()
+
+    def test_upgrade_after_stamping_the_baseline(self):
+        self.manage('db', 'stamp', '3f2a9c1d7b04')
+        self.manage('db', 'upgrade')
+        self.assert_upgraded()
+
+
+'''
+Unit Test for the benchmark report comparison
+'''
+class BenchmarkTestCase(unittest.TestCase):
+    """This class represents the benchmark comparison test case"""
+
+    def test_compare_flags_regressions_beyond_tolerance(self):
+        baseline = {'endpoints': {
+            'list_movies': {'rps': 100, 'p95_ms': 20, 'p99_ms': 30},
+            'search': {'rps': 50, 'p95_ms': 80, 'p99_ms': 90}
+        }}
+        results = {'endpoints': {
+            'list_movies': {'rps': 95, 'p95_ms': 21, 'p99_ms': 31},
+            'search': {'rps': 40, 'p95_ms': 80, 'p99_ms': 120}
+        }}
+
+        regressions = benchmark.compare(results, baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith('search:') for r in regressions))
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file